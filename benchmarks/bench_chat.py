@@ -0,0 +1,144 @@
+"""
+Latency and concurrency of the Dialogflow chat path against a local fake Dialogflow server,
+comparing a fresh client per message with the pooled clients of `dialogflow_client`, and
+load shedding by the admission limiter and circuit breaker against a slow or failing Dialogflow.
+
+Clients are the production dialogflow_lite clients built by `create_dialogflow`, with
+settings.DIALOGFLOW pointed at the fake server; dialogflow_lite has to be installed.
+
+    python -m benchmarks.bench_chat --requests 2000 --concurrency 32 --delay 0.02
+    python -m benchmarks.bench_chat --concurrency 64 --delay 0.5 --max-in-flight 8 --error-rate 0.6
+"""
+import argparse
+import asyncio
+import statistics
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+if not settings.configured:
+    settings.configure(DIALOGFLOW={})
+
+from asgiref.sync import sync_to_async  # noqa: E402
+
+from benchmarks.fake_dialogflow import FakeDialogflowServer  # noqa: E402
+from django_dialogflow.dialogflow_client import (  # noqa: E402
+    AdmissionLimiter, CircuitBreaker, DialogflowPool, DialogflowStatusError, DialogflowUnavailable, UpstreamGuard,
+    check_query_response, create_dialogflow
+)
+
+
+def use_fake_server(server):
+    settings.DIALOGFLOW = {'url': server.url, 'client_access_token': 'bench'}
+
+
+def fresh_chat(server):
+    use_fake_server(server)
+
+    def chat(session_id, text):
+        dialogflow = create_dialogflow()
+        dialogflow.session_id = session_id
+        return dialogflow.text_request(text)
+    return chat
+
+
+def pooled_chat(server, pool_size):
+    use_fake_server(server)
+    pool = DialogflowPool(create_dialogflow, maxsize=pool_size)
+
+    def chat(session_id, text):
+        with pool.client(session_id) as dialogflow:
+            return dialogflow.text_request(text)
+    return chat
+
+
+def guarded_chat(server, pool_size, guard, outcomes):
+    use_fake_server(server)
+    pool = DialogflowPool(create_dialogflow, maxsize=pool_size)
+
+    def chat(session_id, text):
+        try:
+            with pool.client(session_id) as dialogflow, guard.call():
+                dialogflow.text_request(text)
+                check_query_response(dialogflow)
+        except DialogflowUnavailable as e:
+            outcomes.append(e.reason)
+        except DialogflowStatusError:
+            outcomes.append('error')
+        else:
+            outcomes.append('ok')
+    return chat
+
+
+def timed_call(chat, index):
+    start = time.perf_counter()
+    chat('session-{}'.format(index % 100), 'hi')
+    return time.perf_counter() - start
+
+
+def run_threaded(chat, requests, concurrency):
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return list(executor.map(lambda index: timed_call(chat, index), range(requests)))
+
+
+def run_async(chat, requests, concurrency):
+    async def main():
+        semaphore = asyncio.Semaphore(concurrency)
+        achat = sync_to_async(lambda index: timed_call(chat, index), thread_sensitive=False)
+
+        async def one(index):
+            async with semaphore:
+                return await achat(index)
+        return await asyncio.gather(*(one(index) for index in range(requests)))
+    return asyncio.run(main())
+
+
+def report(name, latencies, elapsed, server):
+    latencies = sorted(latencies)
+    quantiles = statistics.quantiles(latencies, n=100)
+    print('{:<14} {:>8.1f} req/s  p50 {:>7.2f}ms  p95 {:>7.2f}ms  p99 {:>7.2f}ms  connections {:>6}'.format(
+        name, len(latencies) / elapsed, quantiles[49] * 1000, quantiles[94] * 1000, quantiles[98] * 1000,
+        server.connections))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--delay', type=float, default=0.01, help='fake Dialogflow latency in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of failing fake Dialogflow calls')
+    parser.add_argument('--max-in-flight', type=int, default=8)
+    parser.add_argument('--max-queue', type=int, default=8)
+    parser.add_argument('--queue-timeout', type=float, default=0.1)
+    args = parser.parse_args()
+
+    scenarios = [
+        ('fresh', lambda server: fresh_chat(server), run_threaded),
+        ('pooled', lambda server: pooled_chat(server, args.concurrency), run_threaded),
+        ('pooled-async', lambda server: pooled_chat(server, args.concurrency), run_async),
+    ]
+    for name, make_chat, run in scenarios:
+        with FakeDialogflowServer(delay=args.delay) as server:
+            chat = make_chat(server)
+            start = time.perf_counter()
+            latencies = run(chat, args.requests, args.concurrency)
+            report(name, latencies, time.perf_counter() - start, server)
+
+    guard = UpstreamGuard(
+        AdmissionLimiter(args.max_in_flight, args.max_queue, args.queue_timeout),
+        CircuitBreaker(window=50, error_rate=0.5, min_calls=20, open_seconds=1),
+    )
+    outcomes = []
+    with FakeDialogflowServer(delay=args.delay, error_rate=args.error_rate) as server:
+        chat = guarded_chat(server, args.concurrency, guard, outcomes)
+        start = time.perf_counter()
+        latencies = run_threaded(chat, args.requests, args.concurrency)
+        report('guarded', latencies, time.perf_counter() - start, server)
+    print('{:<14} {}  limiter {}  breaker {}'.format(
+        '', dict(Counter(outcomes)), guard.limiter.info(), guard.breaker.info()))
+
+
+if __name__ == '__main__':
+    main()
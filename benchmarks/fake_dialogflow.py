@@ -0,0 +1,108 @@
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+def get_fake_query_response(text, session_id, intent_name='Default Welcome Intent'):
+    """
+    Dialogflow V1 /query response payload with a single text message
+    """
+    return {
+        'id': str(uuid.uuid4()),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime()),
+        'lang': 'en',
+        'result': {
+            'source': 'agent',
+            'resolvedQuery': text,
+            'action': 'input.welcome',
+            'actionIncomplete': False,
+            'parameters': {},
+            'contexts': [],
+            'metadata': {
+                'intentId': str(uuid.uuid5(uuid.NAMESPACE_DNS, intent_name)),
+                'webhookUsed': 'false',
+                'webhookForSlotFillingUsed': 'false',
+                'intentName': intent_name,
+            },
+            'fulfillment': {
+                'speech': 'Hi! How can I help?',
+                'messages': [{'type': 0, 'speech': 'Hi! How can I help?'}],
+            },
+            'score': 1.0,
+        },
+        'status': {'code': 200, 'errorType': 'success'},
+        'sessionId': session_id,
+    }
+
+
+class FakeDialogflowHandler(BaseHTTPRequestHandler):
+    """
+    Answers the GET /v1/query requests of dialogflow_lite's Dialogflow client.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_GET(self):
+        params = parse_qs(urlparse(self.path).query)
+        with self.server.lock:
+            self.server.requests += 1
+
+        time.sleep(self.server.delay)
+        if self.server.error_rate and random.random() < self.server.error_rate:
+            self.send_json({'status': {'code': 500, 'errorType': 'internal_server_error'}}, status=500)
+        else:
+            self.send_json(get_fake_query_response(params.get('query', [''])[0], params.get('sessionId', [''])[0]))
+
+    def send_json(self, data, status=200):
+        payload = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeDialogflowServer(ThreadingHTTPServer):
+    """
+    Local stand-in for the Dialogflow API with configurable latency and error rate, counting the
+    TCP connections and requests it served.
+
+    Usage
+    -----
+    with FakeDialogflowServer(delay=0.05) as server:
+        dialogflow = Dialogflow(url=server.url, client_access_token='fake')
+    """
+    daemon_threads = True
+
+    def __init__(self, delay=0.0, error_rate=0.0, address=('127.0.0.1', 0)):
+        super().__init__(address, FakeDialogflowHandler)
+        self.delay = delay
+        self.error_rate = error_rate
+        self.connections = 0
+        self.requests = 0
+        self.lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://{}:{}/v1'.format(*self.server_address)
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,209 @@
+"""
+Synthetic catalogue data for the benchmarks, in the shapes the hot helpers consume.
+"""
+import random
+
+PATH_ALPHABET = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+
+
+def encode_step(number, steplen=4):
+    """
+    treebeard style materialised path step, base 36 and zero padded
+    """
+    step = ''
+    while number:
+        number, remainder = divmod(number, len(PATH_ALPHABET))
+        step = PATH_ALPHABET[remainder] + step
+    return step.rjust(steplen, '0')
+
+
+def generate_category_nodes(depth=3, fanout=5, steplen=4, seed=0):
+    """
+    Category tree of `depth` levels with `fanout` children per node, as CategoryTreeIndex nodes
+
+    Returns
+    -------
+    list of dict
+        [{'id': '', 'name': '', 'priority': '', 'image': '', 'path': '', 'depth': ''}, ...]
+    """
+    rng = random.Random(seed)
+    nodes = []
+    level = ['']
+    for node_depth in range(1, depth + 1):
+        next_level = []
+        for parent_path in level:
+            for child in range(1, fanout + 1):
+                path = parent_path + encode_step(child, steplen)
+                nodes.append({
+                    'id': len(nodes) + 1,
+                    'name': 'Category {}'.format(path),
+                    'priority': rng.randint(0, 10),
+                    'image': '/media/categories/{}.png'.format(path) if node_depth == 2 else None,
+                    'path': path,
+                    'depth': node_depth,
+                })
+                next_level.append(path)
+        level = next_level
+    return nodes
+
+
+def sample_category_ids(nodes, count, seed=0):
+    rng = random.Random(seed)
+    return {node['id'] for node in rng.sample(nodes, min(count, len(nodes)))}
+
+
+def generate_product_stats(products, seed=0, null_rate=0.05):
+    """
+    Raw productstats columns with long tailed order and favourite counts
+
+    Returns
+    -------
+    tuple
+        (product_ids, order_rate, favourite_rate, novelty_rate) lists, None for NULL
+    """
+    rng = random.Random(seed)
+
+    def maybe_null(value):
+        return None if rng.random() < null_rate else value
+
+    product_ids = list(range(1, products + 1))
+    order_rate = [maybe_null(int(rng.paretovariate(1.5)) - 1) for _ in product_ids]
+    favourite_rate = [maybe_null(int(rng.paretovariate(2.0)) - 1) for _ in product_ids]
+    novelty_rate = [maybe_null(rng.randint(0, 60)) for _ in product_ids]
+    return product_ids, order_rate, favourite_rate, novelty_rate
+
+
+def generate_deal_stocks(products, partners, deal_types=5, stocks_per_product=2, seed=0):
+    """
+    Deal type stocks as returned by CacheManager.get_all_deal_type_stocks and the deal type of every product
+
+    Returns
+    -------
+    tuple
+        ([(product id, partner id), ...], [(product id, deal type slug), ...])
+    """
+    rng = random.Random(seed)
+    stocks = [
+        (product_id, rng.randint(1, partners))
+        for product_id in range(1, products + 1)
+        for _ in range(rng.randint(1, stocks_per_product))
+    ]
+    product_deal_types = [
+        (product_id, 'deal-type-{}'.format(rng.randint(1, deal_types))) for product_id in range(1, products + 1)
+    ]
+    return stocks, product_deal_types
+
+
+def sample_excluded_products(products, share=0.1, seed=0):
+    rng = random.Random(seed)
+    return set(rng.sample(range(1, products + 1), int(products * share)))
+
+
+def populate_catalogue(depth=3, fanout=5, products=1000, seed=0):
+    """
+    Create a category tree and published products in the configured database, for the database
+    backed scenarios. Run against a throwaway database only.
+
+    The tree of a given `depth` and `fanout` is created once and reused by later runs, so repeated
+    runs neither pile up rows nor time a growing tree.
+
+    Returns
+    -------
+    list
+        ids of the created categories
+    """
+    from apps.catalogue.models import Category, Product, ProductCategory, ProductClass
+
+    prefix = 'Benchmark {}x{}'.format(depth, fanout)
+    existing = Category.objects.filter(name__startswith=prefix + ' ').order_by('path')
+    if existing.exists():
+        return list(existing.values_list('id', flat=True))
+
+    rng = random.Random(seed)
+    product_class, _ = ProductClass.objects.get_or_create(name=prefix)
+
+    categories = []
+    level = [None]
+    for _ in range(depth):
+        next_level = []
+        for parent in level:
+            for child in range(fanout):
+                name = '{} {}'.format(prefix, len(categories))
+                category = Category.add_root(name=name) if parent is None else parent.add_child(name=name)
+                categories.append(category)
+                next_level.append(category)
+        level = next_level
+
+    Product.objects.bulk_create(
+        Product(title='Benchmark product {}'.format(index), product_class=product_class, published=True)
+        for index in range(products)
+    )
+    # bulk_create does not set primary keys on MySQL
+    ProductCategory.objects.bulk_create(
+        ProductCategory(product_id=product_id, category=rng.choice(categories))
+        for product_id in Product.objects.filter(product_class=product_class).values_list('pk', flat=True)
+    )
+    return [category.id for category in categories]
+
+
+def populate_scoring_data(products=1000, orders_per_product=3, favourite_rate=0.3, seed=0, batch_size=2000):
+    """
+    Create published products with order lines and favourites, the rows `update_product_score` reads
+    from order_line and catalogue_favouriteproduct. Orders are spread over the novelty window. Like
+    `populate_catalogue`, the data of a given size is created once and reused by later runs.
+
+    Returns
+    -------
+    list
+        ids of the scored products
+    """
+    from datetime import timedelta
+    from decimal import Decimal
+
+    from django.contrib.auth import get_user_model
+    from django.utils import timezone
+
+    from apps.catalogue.models import FavouriteProduct, Product, ProductClass
+    from apps.order.models import Line, Order
+
+    rng = random.Random(seed)
+    product_class, created = ProductClass.objects.get_or_create(name='Benchmark scoring {}'.format(products))
+    if not created:
+        return list(Product.objects.filter(product_class=product_class).values_list('pk', flat=True))
+
+    Product.objects.bulk_create(
+        (Product(title='Benchmark scored product {}'.format(index), product_class=product_class, published=True)
+         for index in range(products)),
+        batch_size=batch_size,
+    )
+    product_ids = list(Product.objects.filter(product_class=product_class).values_list('pk', flat=True))
+
+    now = timezone.now()
+    prefix = 'benchmark-{}-'.format(products)
+    Order.objects.bulk_create(
+        (Order(number='{}{}'.format(prefix, index), currency='EUR', total_incl_tax=Decimal('10.00'),
+               total_excl_tax=Decimal('10.00'), date_placed=now - timedelta(days=rng.randint(0, 60)))
+         for index in range(products * orders_per_product)),
+        batch_size=batch_size,
+    )
+    order_ids = list(Order.objects.filter(number__startswith=prefix).values_list('pk', flat=True))
+
+    price = Decimal('10.00')
+    Line.objects.bulk_create(
+        (Line(order_id=order_id, product_id=rng.choice(product_ids), title='Benchmark line',
+              quantity=rng.randint(1, 5), line_price_incl_tax=price, line_price_excl_tax=price,
+              line_price_before_discounts_incl_tax=price, line_price_before_discounts_excl_tax=price)
+         for order_id in order_ids),
+        batch_size=batch_size,
+    )
+
+    User = get_user_model()
+    user = User.objects.order_by('pk').first()
+    if user is None:
+        user = User.objects.create(**{User.USERNAME_FIELD: 'benchmark@example.com'})
+    FavouriteProduct.objects.bulk_create(
+        (FavouriteProduct(product_id=product_id, user=user)
+         for product_id in rng.sample(product_ids, int(len(product_ids) * favourite_rate))),
+        batch_size=batch_size,
+    )
+    return product_ids
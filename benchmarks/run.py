@@ -0,0 +1,245 @@
+"""
+Benchmarks of the scoring, category hierarchy and deal filtering helpers on synthetic data.
+
+Every scenario reports its best and median wall time, database query count and peak Python
+memory, and is compared against a stored baseline so regressions show before deploy.
+
+    DJANGO_SETTINGS_MODULE=... python -m benchmarks.run --size medium
+    DJANGO_SETTINGS_MODULE=... python -m benchmarks.run --size medium --save-baseline
+    DJANGO_SETTINGS_MODULE=... python -m benchmarks.run --db --scenario scoring_sql
+
+Database backed scenarios (--db) write to the configured database, point it at a throwaway
+SQLite or MySQL stand-in. Their data is created on the first run and reused afterwards.
+`scoring_sql` needs MySQL and scores generated products, orders and favourites.
+
+`deal_filter_legacy` reproduces the quadratic filtering the deal type index replaced, from
+--size medium up it takes minutes per repeat.
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+
+import django
+
+django.setup()
+
+from django.db import connection  # noqa: E402
+from django.test.utils import override_settings  # noqa: E402
+
+from benchmarks import generators  # noqa: E402
+from django_dialogflow.instrumentation import QueryRecorder  # noqa: E402
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+SIZES = {
+    'small': {'products': 10000, 'depth': 3, 'fanout': 5, 'partners': 200, 'lookups': 200},
+    'medium': {'products': 100000, 'depth': 4, 'fanout': 6, 'partners': 2000, 'lookups': 500},
+    'large': {'products': 1000000, 'depth': 5, 'fanout': 6, 'partners': 10000, 'lookups': 1000},
+}
+
+LOCMEM_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+scenarios = {}
+
+
+def scenario(name, db=False):
+    """
+    Register a scenario. `setup(size)` returns the callable which is timed.
+    """
+    def decorator(setup):
+        scenarios[name] = {'setup': setup, 'db': db}
+        return setup
+    return decorator
+
+
+@scenario('scoring_numpy')
+def scoring_numpy(size):
+    from django_dialogflow.product_scoring import DEFAULT_SCORE_WEIGHTS, score_product_stats
+
+    _, order_rate, favourite_rate, novelty_rate = generators.generate_product_stats(size['products'])
+    # NumPy reads the None of NULL columns as NaN
+    return lambda: score_product_stats(order_rate, favourite_rate, novelty_rate, weights=DEFAULT_SCORE_WEIGHTS)
+
+
+@scenario('scoring_sql', db=True)
+def scoring_sql(size):
+    from django_dialogflow.product_scoring import get_scoring_backend, update_product_score
+
+    if connection.vendor != 'mysql':
+        return None
+    generators.populate_scoring_data(size['products'])
+    return lambda: update_product_score(backend=get_scoring_backend('sql'))
+
+
+@scenario('hierarchy_cold')
+def hierarchy_cold(size):
+    from django_dialogflow.utils import CategoryTreeIndex, build_category_hierarchy, freeze_category_hierarchy
+
+    nodes = generators.generate_category_nodes(size['depth'], size['fanout'])
+    lookups = [generators.sample_category_ids(nodes, 30, seed) for seed in range(size['lookups'])]
+
+    def run():
+        index = CategoryTreeIndex(nodes, version=1)
+        for category_ids in lookups:
+            freeze_category_hierarchy(build_category_hierarchy(index, category_ids))
+    return run
+
+
+@scenario('hierarchy_memoised')
+def hierarchy_memoised(size):
+    from django_dialogflow import utils
+
+    nodes = generators.generate_category_nodes(size['depth'], size['fanout'])
+    # a handful of id sets requested over and over, as on deal and search pages
+    lookups = [generators.sample_category_ids(nodes, 30, seed % 20) for seed in range(size['lookups'])]
+
+    def run():
+        with override_settings(CACHES=LOCMEM_CACHES):
+            from django.core.cache import cache
+
+            cache.set(utils.CATEGORY_TREE_VERSION_CACHE_KEY, 1, None)
+            cache.set(utils.CATEGORY_TREE_CACHE_KEY, (1, nodes), None)
+            utils.category_hierarchy_cache.clear()
+            for category_ids in lookups:
+                utils.get_category_hierarchy(category_ids)
+    return run
+
+
+@scenario('hierarchy_db', db=True)
+def hierarchy_db(size):
+    from django_dialogflow import utils
+
+    category_ids = generators.populate_catalogue(size['depth'], min(size['fanout'], 4), products=0)
+    lookups = [set(category_ids[seed::max(1, len(category_ids) // 30)]) for seed in range(20)]
+
+    def run():
+        utils.invalidate_category_tree_index()
+        utils.category_hierarchy_cache.clear()
+        for category_ids in lookups:
+            utils.get_category_hierarchy(category_ids)
+    return run
+
+
+@scenario('deal_filter_index')
+def deal_filter_index(size):
+    from django_dialogflow.utils import DealTypeIndex
+
+    stocks, product_deal_types = generators.generate_deal_stocks(size['products'], size['partners'])
+    excluded = [generators.sample_excluded_products(size['products'], seed=seed) for seed in range(10)]
+
+    def run():
+        index = DealTypeIndex.build(stocks, product_deal_types)
+        for excluded_products in excluded:
+            index.get_partners(excluded_products, None)
+            index.get_stocks(excluded_products, ['deal-type-1', 'deal-type-2'])
+    return run
+
+
+@scenario('deal_filter_legacy')
+def deal_filter_legacy(size):
+    stocks, product_deal_types = generators.generate_deal_stocks(size['products'], size['partners'])
+    excluded = [generators.sample_excluded_products(size['products'], seed=seed) for seed in range(10)]
+    filter_deal_type = ['deal-type-1', 'deal-type-2']
+
+    def get_deal_type_product_stocks(excluded_products, filter_deal_type):
+        # get_deal_type_product_stocks before the deal type index, the deal type products queryset
+        # is fetched on every call and `in` scans its result list, so this is quadratic
+        deal_type_stocks = list(filter(lambda stock: stock[0] not in excluded_products, stocks))
+        if filter_deal_type:
+            deal_type_products = [product_id for product_id, slug in product_deal_types if slug in filter_deal_type]
+            deal_type_stocks = list(filter(lambda stock: stock[0] in deal_type_products, deal_type_stocks))
+        return deal_type_stocks
+
+    def run():
+        for excluded_products in excluded:
+            # active_deal_type_partners
+            set(stock[1] for stock in get_deal_type_product_stocks(excluded_products, None))
+            get_deal_type_product_stocks(excluded_products, filter_deal_type)
+    return run
+
+
+def measure(run, repeat):
+    recorder = QueryRecorder()
+    timings = []
+    peak = 0
+    with connection.execute_wrapper(recorder):
+        for _ in range(repeat):
+            tracemalloc.start()
+            start = time.perf_counter()
+            run()
+            timings.append(time.perf_counter() - start)
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+    return {
+        'best_seconds': min(timings),
+        'median_seconds': statistics.median(timings),
+        'queries': recorder.count // repeat,
+        'peak_memory_kb': peak // 1024,
+    }
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for key, result in results.items():
+        previous = baseline.get(key)
+        if not previous:
+            continue
+        for metric in ('best_seconds', 'queries', 'peak_memory_kb'):
+            if result[metric] > previous[metric] * (1 + tolerance) and result[metric] - previous[metric] > 0:
+                regressions.append('{} {}: {} -> {}'.format(key, metric, previous[metric], result[metric]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', choices=sorted(SIZES), default='small')
+    parser.add_argument('--depth', type=int, choices=range(2, 6), help='category tree depth, overrides --size')
+    parser.add_argument('--scenario', action='append', choices=sorted(scenarios))
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--db', action='store_true', help='also run the database backed scenarios')
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown before failing')
+    args = parser.parse_args()
+
+    size = dict(SIZES[args.size])
+    if args.depth:
+        size['depth'] = args.depth
+
+    results = {}
+    for name in args.scenario or sorted(scenarios):
+        if scenarios[name]['db'] and not args.db:
+            continue
+        run = scenarios[name]['setup'](size)
+        if run is None:
+            print('{:<22} skipped'.format(name))
+            continue
+        # keyed by depth too, a --depth run must not be compared with the default depth of its size
+        result = results['{}:{}:depth{}'.format(name, args.size, size['depth'])] = measure(run, args.repeat)
+        print('{:<22} best {:>9.4f}s  median {:>9.4f}s  queries {:>6}  peak {:>8} KiB'.format(
+            name, result['best_seconds'], result['median_seconds'], result['queries'], result['peak_memory_kb']))
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+
+    if args.save_baseline:
+        baseline.update(results)
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump(baseline, baseline_file, indent=2, sort_keys=True)
+        print('baseline saved to {}'.format(args.baseline))
+        return
+
+    regressions = compare(results, baseline, args.tolerance)
+    for regression in regressions:
+        print('REGRESSION {}'.format(regression))
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+import base64
+import gzip
+import json
+import logging
+import os
+import zlib
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+
+from django_dialogflow.models import ChatHistory
+
+logger = logging.getLogger(__name__)
+
+# fields of a Dialogflow `result` read by the chat widget, history pages and reports,
+# everything else is packed into PACKED_FIELD
+KEPT_FIELDS = {
+    'resolvedQuery': None,
+    'action': None,
+    'score': None,
+    'fulfillment': ('messages',),
+    'metadata': ('intentName',),
+}
+PACKED_FIELD = 'packed'
+
+# preset zlib dictionaries of the packed fields, short payloads compress far better with them. Packed
+# values carry the version of their dictionary, add a new version instead of changing an existing one
+PACKED_DICTIONARIES = {
+    '1': (b'{"source":"agent","actionIncomplete":false,"parameters":{},"contexts":[],'
+          b'"metadata":{"intentId":"","webhookUsed":"false","webhookForSlotFillingUsed":"false"},'
+          b'"fulfillment":{"speech":""}}'),
+}
+PACKED_VERSION = '1'
+
+RETENTION_DAYS = 90
+ARCHIVE_BATCH_SIZE = 2000
+
+
+def compact_chat_response(result):
+    """
+    Keep the read fields of a Dialogflow `result` as they are and zlib compress the rest with a preset
+    dictionary, see PACKED_DICTIONARIES.
+
+    The compact dict has the same layout for the kept fields, e.g. `['fulfillment']['messages']`,
+    see `expand_chat_response` for the reverse.
+
+    Returns
+    -------
+    dict
+    """
+    if not result:
+        return result
+
+    compact, rest = {}, {}
+    for key, value in result.items():
+        kept = KEPT_FIELDS.get(key, False)
+        if kept is None:
+            compact[key] = value
+        elif kept and isinstance(value, dict):
+            compact[key] = {field: value[field] for field in kept if field in value}
+            other = {field: item for field, item in value.items() if field not in kept}
+            if other:
+                rest[key] = other
+        else:
+            rest[key] = value
+
+    if rest:
+        compressor = zlib.compressobj(level=9, zdict=PACKED_DICTIONARIES[PACKED_VERSION])
+        packed = compressor.compress(json.dumps(rest, separators=(',', ':'), cls=DjangoJSONEncoder).encode('utf-8'))
+        packed += compressor.flush()
+        compact[PACKED_FIELD] = '{}:{}'.format(PACKED_VERSION, base64.b64encode(packed).decode('ascii'))
+    return compact
+
+
+def expand_chat_response(compact):
+    """
+    Full Dialogflow `result` of a compact chat response, uncompacted responses are returned as is.
+    """
+    if not isinstance(compact, dict) or PACKED_FIELD not in compact:
+        return compact
+
+    result = {key: dict(value) if isinstance(value, dict) else value
+              for key, value in compact.items() if key != PACKED_FIELD}
+    version, packed = compact[PACKED_FIELD].split(':', 1)
+    decompressor = zlib.decompressobj(zdict=PACKED_DICTIONARIES[version])
+    rest = json.loads(decompressor.decompress(base64.b64decode(packed)).decode('utf-8'))
+    for key, value in rest.items():
+        if isinstance(value, dict) and isinstance(result.get(key), dict):
+            result[key].update(value)
+        else:
+            result[key] = value
+    return result
+
+
+def get_day_start(moment):
+    if timezone.is_aware(moment):
+        moment = timezone.localtime(moment)
+    return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def archive_chat_history(retention_days=None, directory=None, batch_size=ARCHIVE_BATCH_SIZE):
+    """
+    Move chat history older than `retention_days` into one gzipped JSON lines file per day.
+
+    Each day is written in primary key chunks to `chat_history-<date>.jsonl.gz` in `directory`, with
+    expanded chat responses, and the written rows are deleted in batches only once the file is complete.
+    An interrupted run is simply repeated: rows already in a complete file of their day are deleted
+    without being written again, and only rows never archived go to `chat_history-<date>.1.jsonl.gz`.
+    Defaults come from the CHAT_HISTORY_RETENTION_DAYS and CHAT_HISTORY_ARCHIVE_DIR settings.
+
+    Returns
+    -------
+    dict
+        number of archived rows per file path
+    """
+    retention_days = retention_days or getattr(settings, 'CHAT_HISTORY_RETENTION_DAYS', RETENTION_DAYS)
+    directory = directory or settings.CHAT_HISTORY_ARCHIVE_DIR
+    os.makedirs(directory, exist_ok=True)
+
+    cutoff = get_day_start(timezone.now()) - timedelta(days=retention_days)
+    oldest = ChatHistory.objects.filter(time_stamp__lt=cutoff).order_by('time_stamp').values_list(
+        'time_stamp', flat=True).first()
+
+    archived = {}
+    start = get_day_start(oldest) if oldest is not None else cutoff
+    while start < cutoff:
+        end = start + timedelta(days=1)
+        rows = ChatHistory.objects.filter(time_stamp__gte=start, time_stamp__lt=end)
+        if rows.exists():
+            archive_paths = get_day_archive_paths(directory, start.date())
+            # rows already in a complete file, left behind by an interrupted run
+            delete_rows(get_archived_pks(archive_paths), batch_size)
+
+            if rows.exists():
+                path = get_archive_path(directory, start.date(), len(archive_paths))
+                pks = write_archive(path, rows, batch_size)
+                archived[path] = len(pks)
+                delete_rows(pks, batch_size)
+                logger.info('archived %d chat history rows to %s', archived[path], path)
+        start = end
+    return archived
+
+
+def get_archive_path(directory, day, suffix=0):
+    base = os.path.join(directory, 'chat_history-{}'.format(day.isoformat()))
+    return '{}.{}.jsonl.gz'.format(base, suffix) if suffix else base + '.jsonl.gz'
+
+
+def get_day_archive_paths(directory, day):
+    """
+    Paths of the complete archive files of `day`
+    """
+    paths = []
+    while os.path.exists(get_archive_path(directory, day, len(paths))):
+        paths.append(get_archive_path(directory, day, len(paths)))
+    return paths
+
+
+def get_archived_pks(paths):
+    pks = []
+    for path in paths:
+        with gzip.open(path, 'rt', encoding='utf-8') as archive:
+            pks.extend(json.loads(line)['pk'] for line in archive)
+    return pks
+
+
+def delete_rows(pks, batch_size):
+    for i in range(0, len(pks), batch_size):
+        ChatHistory.objects.filter(pk__in=pks[i:i + batch_size]).delete()
+
+
+def write_archive(path, rows, batch_size):
+    """
+    Write `rows` to a gzipped JSON lines file, replacing `path` only once it is complete.
+
+    Returns
+    -------
+    list
+        primary keys of the written rows
+    """
+    pks = []
+    last_pk = 0
+    partial_path = path + '.partial'
+    with gzip.open(partial_path, 'wt', encoding='utf-8') as archive:
+        while True:
+            chunk = list(rows.filter(pk__gt=last_pk).order_by('pk').values(
+                'pk', 'session_id', 'time_stamp', 'chat_request', 'chat_response'
+            )[:batch_size])
+            if not chunk:
+                break
+            for row in chunk:
+                row['chat_response'] = expand_chat_response(row['chat_response'])
+                archive.write(json.dumps(row, cls=DjangoJSONEncoder) + '\n')
+                pks.append(row['pk'])
+            last_pk = chunk[-1]['pk']
+    os.replace(partial_path, path)
+    return pks
@@ -0,0 +1,71 @@
+import functools
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+
+# 'session' keeps a Django session per visitor, 'signed' issues a stateless id in a signed cookie,
+# 'cache' does the same but only accepts ids still alive in cache, so they can expire server side
+MODE_SESSION = 'session'
+MODE_SIGNED = 'signed'
+MODE_CACHE = 'cache'
+
+MODE = getattr(settings, 'CHAT_SESSION_MODE', MODE_SESSION)
+COOKIE_NAME = getattr(settings, 'CHAT_SESSION_COOKIE_NAME', 'chat_session')
+TTL = getattr(settings, 'CHAT_SESSION_TTL', 24 * 60 * 60)
+
+SALT = 'django_dialogflow.chat_session'
+CACHE_KEY = 'chat_session:{session_id}'
+
+
+def get_chat_session_id(request):
+    """
+    Get the chat session id of the visitor, issuing a new one if needed, see CHAT_SESSION_MODE.
+
+    Ids issued in the 'signed' and 'cache' modes are 32 hex characters like a Django session key,
+    so they fit the Dialogflow session id and ChatHistory.session_id alike.
+
+    Returns
+    -------
+    str
+    """
+    if MODE == MODE_SESSION:
+        if not request.session.session_key:
+            request.session.save()
+        return request.session.session_key
+
+    session_id = request.get_signed_cookie(COOKIE_NAME, default=None, salt=SALT, max_age=TTL)
+    if MODE == MODE_CACHE:
+        if session_id is not None and not cache.touch(CACHE_KEY.format(session_id=session_id), TTL):
+            session_id = None
+        if session_id is None:
+            session_id = uuid.uuid4().hex
+            cache.set(CACHE_KEY.format(session_id=session_id), 1, TTL)
+    elif session_id is None:
+        session_id = uuid.uuid4().hex
+    return session_id
+
+
+def with_chat_session(view):
+    """
+    Decorator setting `request.chat_session_id` before the view runs and, unless sessions are kept
+    in the database, (re)signing it into the chat session cookie of the response, so it expires
+    `CHAT_SESSION_TTL` seconds after the last request.
+
+    Usage
+    -----
+    @with_chat_session
+    def chat_view(request):
+        pooled_chat_dialogflow(request.chat_session_id, input_text)
+    """
+    @functools.wraps(view)
+    def wrapper(request, *args, **kwargs):
+        request.chat_session_id = get_chat_session_id(request)
+        response = view(request, *args, **kwargs)
+        if MODE != MODE_SESSION:
+            response.set_signed_cookie(
+                COOKIE_NAME, request.chat_session_id, salt=SALT, max_age=TTL,
+                secure=request.is_secure(), httponly=True, samesite='Lax',
+            )
+        return response
+    return wrapper
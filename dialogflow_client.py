@@ -0,0 +1,456 @@
+import copy
+import queue
+import string
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager, nullcontext
+
+from django.conf import settings
+from django.core.cache import cache
+
+from django_dialogflow.instrumentation import external_call
+
+
+class DialogflowUnavailable(Exception):
+    """
+    Raised instead of calling Dialogflow when the call was shed, answer with a 503 and `retry_after`.
+    """
+
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class DialogflowStatusError(Exception):
+    """
+    Dialogflow answered with an error status, dialogflow_lite returns those without raising.
+    """
+
+
+def check_query_response(dialogflow):
+    """
+    Raise DialogflowStatusError if the last query of `dialogflow` has no result or failed server side.
+    Other statuses come with a usable result, e.g. 206 `partial_content` when the webhook failed.
+    """
+    query_response = dialogflow.query_response or {}
+    status = query_response.get('status') or {}
+    code = status.get('code')
+    if 'result' not in query_response or (isinstance(code, int) and code >= 500):
+        raise DialogflowStatusError(status)
+
+
+def create_dialogflow():
+    from dialogflow_lite.dialogflow import Dialogflow
+
+    return Dialogflow(**settings.DIALOGFLOW)
+
+
+class DialogflowPool(object):
+    """
+    Pool of reusable Dialogflow clients. A client is checked out by one request at a time, so its
+    `session_id` and `query_response` are never shared, and is kept afterwards together with the
+    connections it holds instead of being rebuilt for every chat message.
+    """
+
+    def __init__(self, factory=create_dialogflow, maxsize=8):
+        self.factory = factory
+        self.maxsize = maxsize
+        self.created = 0
+        self._idle = queue.LifoQueue(maxsize)
+
+    @contextmanager
+    def client(self, session_id):
+        try:
+            dialogflow = self._idle.get_nowait()
+        except queue.Empty:
+            dialogflow = self.factory()
+            self.created += 1
+
+        dialogflow.session_id = session_id
+        try:
+            yield dialogflow
+        except DialogflowUnavailable:
+            # shed before anything was sent, the client is still good
+            self._release(dialogflow)
+            raise
+        # a client which failed mid request may hold a broken connection, so it is only released on success
+        self._release(dialogflow)
+
+    def info(self):
+        return {'created': self.created, 'idle': self._idle.qsize(), 'maxsize': self.maxsize}
+
+    def _release(self, dialogflow):
+        dialogflow.session_id = None
+        try:
+            self._idle.put_nowait(dialogflow)
+        except queue.Full:
+            pass
+
+
+dialogflow_pool = DialogflowPool(maxsize=getattr(settings, 'DIALOGFLOW_POOL_SIZE', 8))
+
+
+def dialogflow_client(session_id):
+    """
+    Check out a pooled Dialogflow client for `session_id`
+
+    Usage
+    -----
+    with dialogflow_client(session_id) as dialogflow:
+        dialogflow.text_request(text)
+    """
+    return dialogflow_pool.client(session_id)
+
+
+class AdmissionLimiter(object):
+    """
+    Bounds the Dialogflow calls in flight to `max_in_flight`. Up to `max_queue` callers wait at most
+    `queue_timeout` seconds for a slot, any others are rejected right away with DialogflowUnavailable,
+    so a slow Dialogflow cannot tie up every worker.
+    """
+
+    def __init__(self, max_in_flight=16, max_queue=32, queue_timeout=0.5):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+
+        self.in_flight = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+
+        self._condition = threading.Condition()
+
+    @contextmanager
+    def slot(self):
+        with self._condition:
+            if self.in_flight >= self.max_in_flight:
+                if self.waiting >= self.max_queue:
+                    self.rejected += 1
+                    raise DialogflowUnavailable('queue full', self.queue_timeout)
+
+                self.waiting += 1
+                try:
+                    admitted = self._condition.wait_for(
+                        lambda: self.in_flight < self.max_in_flight, self.queue_timeout
+                    )
+                finally:
+                    self.waiting -= 1
+                if not admitted:
+                    self.timed_out += 1
+                    raise DialogflowUnavailable('queue timeout', self.queue_timeout)
+
+            self.in_flight += 1
+            self.admitted += 1
+
+        try:
+            yield
+        finally:
+            with self._condition:
+                self.in_flight -= 1
+                self._condition.notify()
+
+    def info(self):
+        return {
+            'in_flight': self.in_flight,
+            'max_in_flight': self.max_in_flight,
+            'waiting': self.waiting,
+            'admitted': self.admitted,
+            'rejected': self.rejected,
+            'timed_out': self.timed_out,
+        }
+
+
+CIRCUIT_CLOSED = 'closed'
+CIRCUIT_OPEN = 'open'
+CIRCUIT_HALF_OPEN = 'half_open'
+
+
+class CircuitBreaker(object):
+    """
+    Opens once at least `min_calls` of the last `window` Dialogflow calls were made and more than
+    `error_rate` of them failed. While open, calls fail fast with DialogflowUnavailable for
+    `open_seconds`, then a single trial call is let through: success closes the circuit, failure
+    opens it again.
+    """
+
+    def __init__(self, window=50, error_rate=0.5, min_calls=20, open_seconds=30):
+        self.window = window
+        self.error_rate = error_rate
+        self.min_calls = min_calls
+        self.open_seconds = open_seconds
+
+        self.state = CIRCUIT_CLOSED
+        self.opened = 0
+        self.short_circuited = 0
+
+        self._outcomes = deque(maxlen=window)
+        self._opened_until = 0.0
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        with self._lock:
+            if self.state == CIRCUIT_CLOSED:
+                return
+
+            retry_after = self._opened_until - time.monotonic()
+            if self.state == CIRCUIT_OPEN and retry_after <= 0:
+                self.state = CIRCUIT_HALF_OPEN
+            if self.state == CIRCUIT_HALF_OPEN and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return
+
+            self.short_circuited += 1
+            raise DialogflowUnavailable('circuit open', max(retry_after, 1))
+
+    def record(self, success):
+        with self._lock:
+            if self.state == CIRCUIT_OPEN:
+                # calls started before the circuit opened
+                return
+            if self.state == CIRCUIT_HALF_OPEN:
+                self._trial_in_flight = False
+                if success:
+                    self.state = CIRCUIT_CLOSED
+                    self._outcomes.clear()
+                else:
+                    self._open()
+                return
+
+            self._outcomes.append(success)
+            if len(self._outcomes) >= self.min_calls and self.get_error_rate() > self.error_rate:
+                self._open()
+
+    def cancel_call(self):
+        """
+        The call allowed by `before_call` was not made
+        """
+        with self._lock:
+            if self.state == CIRCUIT_HALF_OPEN:
+                self._trial_in_flight = False
+
+    def get_error_rate(self):
+        if not self._outcomes:
+            return 0.0
+        return self._outcomes.count(False) / len(self._outcomes)
+
+    def info(self):
+        return {
+            'open': int(self.state != CIRCUIT_CLOSED),
+            'half_open': int(self.state == CIRCUIT_HALF_OPEN),
+            'error_rate': self.get_error_rate(),
+            'opened': self.opened,
+            'short_circuited': self.short_circuited,
+        }
+
+    def _open(self):
+        self.state = CIRCUIT_OPEN
+        self.opened += 1
+        self._opened_until = time.monotonic() + self.open_seconds
+        self._outcomes.clear()
+
+
+class UpstreamGuard(object):
+    """
+    Admission control and circuit breaking around calls to Dialogflow
+
+    Usage
+    -----
+    with dialogflow_guard.call():
+        dialogflow.text_request(text)
+    """
+
+    def __init__(self, limiter, breaker):
+        self.limiter = limiter
+        self.breaker = breaker
+
+    @contextmanager
+    def call(self):
+        self.breaker.before_call()
+        try:
+            with self.limiter.slot():
+                yield
+        except DialogflowUnavailable:
+            # shed by the limiter, not an upstream failure
+            self.breaker.cancel_call()
+            raise
+        except Exception:
+            self.breaker.record(False)
+            raise
+        self.breaker.record(True)
+
+
+dialogflow_guard = UpstreamGuard(
+    AdmissionLimiter(**getattr(settings, 'DIALOGFLOW_ADMISSION', {})),
+    CircuitBreaker(**getattr(settings, 'DIALOGFLOW_CIRCUIT_BREAKER', {})),
+)
+
+
+class InFlightRequest(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.query_response = None
+
+
+SESSION_CONTEXT_CACHE_KEY = 'dialogflow:session_context:{session_id}'
+
+
+class DialogflowResponseCache(object):
+    """
+    Opt-in cache in front of `Dialogflow.text_request` for context-free intents.
+
+    Responses are keyed on normalised input text and language, kept `ttl` seconds and evicted least
+    recently used beyond `max_size`. Only responses whose intent is in `intents` and which set no
+    output contexts are cached, and sessions left with active contexts bypass the cache until a
+    response clears them or `context_ttl` seconds pass; that flag lives in the shared cache, so every
+    worker sees it. Identical requests for an intent known to be cacheable, i.e. whose response expired,
+    arriving while one is in flight wait for it, at most the `queue_timeout` of the guard's limiter,
+    instead of calling Dialogflow again.
+
+    Calls which do reach Dialogflow go through `guard`, see UpstreamGuard.
+    """
+
+    def __init__(self, intents=(), ttl=300, max_size=1024, context_ttl=20 * 60, guard=None):
+        self.intents = frozenset(intents)
+        self.guard = guard
+        self.ttl = ttl
+        self.max_size = max_size
+        self.context_ttl = context_ttl
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.coalesced_hits = 0
+        self.upstream_calls = 0
+        self.upstream_seconds = 0.0
+
+        self._responses = OrderedDict()
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def normalize(text):
+        return ' '.join(str(text).casefold().split()).strip(string.punctuation + ' ')
+
+    def text_request(self, dialogflow, text):
+        """
+        Same as `dialogflow.text_request(text)`, sets `dialogflow.query_response` either way
+        """
+        if not self.intents or cache.get(SESSION_CONTEXT_CACHE_KEY.format(session_id=dialogflow.session_id)):
+            return self._upstream(dialogflow, text)
+
+        key = (self.normalize(text), getattr(dialogflow, 'language', None) or 'en')
+        with self._lock:
+            cached = self._responses.get(key)
+            if cached is not None and cached[0] > time.monotonic():
+                self._responses.move_to_end(key)
+                self.hits += 1
+                return self._serve(dialogflow, cached[1])
+
+            # only requests for a known cacheable intent, an expired response, are coalesced, others
+            # may well not be cacheable and would only be made to wait for each other
+            in_flight = self._in_flight.get(key) if cached is not None else None
+            if in_flight is None:
+                self.misses += 1
+                if cached is None:
+                    leader = None
+                else:
+                    leader = self._in_flight[key] = InFlightRequest()
+            else:
+                self.coalesced += 1
+
+        if in_flight is not None:
+            timeout = self.guard.limiter.queue_timeout if self.guard else None
+            if not in_flight.done.wait(timeout):
+                raise DialogflowUnavailable('coalesced request timeout', timeout)
+            if in_flight.query_response is not None:
+                with self._lock:
+                    self.coalesced_hits += 1
+                return self._serve(dialogflow, in_flight.query_response)
+            # the leading request was not cacheable or failed, ask Dialogflow ourselves
+            return self._upstream(dialogflow, text)
+
+        if leader is None:
+            response = self._upstream(dialogflow, text)
+            self._store(key, dialogflow.query_response)
+            return response
+
+        try:
+            response = self._upstream(dialogflow, text)
+            if self._store(key, dialogflow.query_response):
+                leader.query_response = dialogflow.query_response
+            return response
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+            leader.done.set()
+
+    def is_cacheable(self, query_response):
+        result = (query_response or {}).get('result') or {}
+        return not result.get('contexts') and result.get('metadata', {}).get('intentName') in self.intents
+
+    def info(self):
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'coalesced_hits': self.coalesced_hits,
+            # coalesced requests whose leader was not cacheable went to Dialogflow themselves
+            'hit_rate': (self.hits + self.coalesced_hits) / lookups if lookups else 0.0,
+            'size': len(self._responses),
+            'upstream_calls': self.upstream_calls,
+            'upstream_seconds': self.upstream_seconds,
+        }
+
+    def _upstream(self, dialogflow, text):
+        with self.guard.call() if self.guard else nullcontext():
+            start = time.perf_counter()
+            try:
+                with external_call('dialogflow'):
+                    response = dialogflow.text_request(text)
+                    check_query_response(dialogflow)
+            finally:
+                elapsed = time.perf_counter() - start
+                with self._lock:
+                    self.upstream_calls += 1
+                    self.upstream_seconds += elapsed
+
+        if self.intents:
+            self._track_contexts(dialogflow)
+        return response
+
+    def _track_contexts(self, dialogflow):
+        key = SESSION_CONTEXT_CACHE_KEY.format(session_id=dialogflow.session_id)
+        result = (dialogflow.query_response or {}).get('result') or {}
+        if result.get('contexts'):
+            cache.set(key, True, self.context_ttl)
+        else:
+            cache.delete(key)
+
+    def _store(self, key, query_response):
+        if not self.is_cacheable(query_response):
+            return False
+        with self._lock:
+            self._responses[key] = (time.monotonic() + self.ttl, query_response)
+            self._responses.move_to_end(key)
+            while len(self._responses) > self.max_size:
+                self._responses.popitem(last=False)
+        return True
+
+    def _serve(self, dialogflow, query_response):
+        query_response = copy.deepcopy(query_response)
+        query_response['sessionId'] = dialogflow.session_id
+        dialogflow.query_response = query_response
+        # what dialogflow_lite's text_request returns
+        return [message['speech'] for message in query_response['result']['fulfillment']['messages']
+                if 'speech' in message]
+
+
+dialogflow_response_cache = DialogflowResponseCache(
+    guard=dialogflow_guard, **getattr(settings, 'DIALOGFLOW_RESPONSE_CACHE', {})
+)
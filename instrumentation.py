@@ -0,0 +1,301 @@
+import functools
+import logging
+import os
+import random
+import re
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connection
+from django.http import HttpResponse, HttpResponseForbidden, JsonResponse
+
+logger = logging.getLogger(__name__)
+
+ENABLED = getattr(settings, 'INSTRUMENTATION_ENABLED', True)
+# share of instrumented calls whose SQL is kept in `query_samples`
+QUERY_SAMPLE_RATE = getattr(settings, 'INSTRUMENTATION_QUERY_SAMPLE_RATE', 0.0)
+# addresses allowed to scrape the metrics besides staff, behind a proxy on the same host every request
+# comes from 127.0.0.1, so only list addresses which are not shared with public traffic
+METRICS_ALLOWED_IPS = getattr(settings, 'INSTRUMENTATION_METRICS_ALLOWED_IPS', ())
+
+SECONDS_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+
+class Histogram(object):
+    """
+    Cumulative bucket histogram in the Prometheus layout.
+    """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                index = i
+                break
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def snapshot(self):
+        with self._lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        cumulative, buckets = 0, []
+        for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += bucket_count
+            buckets.append((bound, cumulative))
+        return {'buckets': buckets, 'sum': total, 'count': count}
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(key, value) for key, value in labels) + '}'
+
+
+class Registry(object):
+    """
+    Histograms keyed by metric name and label values, plus gauges read from `info()` style callables.
+    """
+
+    def __init__(self):
+        self.histograms = {}
+        self.gauges = {}
+        self._lock = threading.Lock()
+
+    def histogram(self, metric, buckets=SECONDS_BUCKETS, **labels):
+        key = (metric, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self.histograms.setdefault(key, Histogram(buckets))
+        return histogram
+
+    def register_gauges(self, name, info):
+        """
+        Export the numeric values of `info()` as gauges `<name>_<key>`
+        """
+        self.gauges[name] = info
+
+    def to_dict(self):
+        histograms = [
+            dict(histogram.snapshot(), name=name, labels=dict(labels))
+            for (name, labels), histogram in sorted(self.histograms.items())
+        ]
+        for histogram in histograms:
+            histogram['buckets'] = [['+Inf' if bound == float('inf') else bound, count]
+                                    for bound, count in histogram['buckets']]
+        gauges = {name: info() for name, info in sorted(self.gauges.items())}
+        return {'histograms': histograms, 'gauges': gauges, 'query_samples': list(query_samples)}
+
+    def to_prometheus(self):
+        lines = []
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            snapshot = histogram.snapshot()
+            for bound, count in snapshot['buckets']:
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('{}_bucket{} {}'.format(name, format_labels(labels + (('le', le),)), count))
+            lines.append('{}_sum{} {}'.format(name, format_labels(labels), snapshot['sum']))
+            lines.append('{}_count{} {}'.format(name, format_labels(labels), snapshot['count']))
+        for name, info in sorted(self.gauges.items()):
+            for key, value in sorted(info().items()):
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    lines.append('{}_{} {}'.format(name, key, value))
+        return '\n'.join(lines) + '\n'
+
+
+class BootTimeline(object):
+    """
+    Seconds from process start (or the import of this module where /proc is unavailable) to each boot
+    phase of this worker, plus the latency of its first request.
+
+    Usage
+    -----
+    with boot_timeline.phase('warm_up'):
+        ...
+    boot_timeline.mark('ready')
+    """
+
+    def __init__(self):
+        self.started = time.time() - get_process_age()
+        self.marks = []
+        self.durations = {}
+        self.first_request_seconds = None
+
+    def mark(self, name):
+        self.marks.append((name, time.time() - self.started))
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.durations[name] = time.perf_counter() - start
+            self.mark(name)
+
+    def record_first_request(self, seconds):
+        if self.first_request_seconds is None:
+            self.first_request_seconds = seconds
+            self.mark('first_request')
+            logger.info('boot timeline: %s', ', '.join('{} {:.3f}s'.format(*mark) for mark in self.marks))
+
+    def info(self):
+        info = {'{}_at_seconds'.format(metric_name(name)): seconds for name, seconds in self.marks}
+        info.update(('{}_seconds'.format(metric_name(name)), seconds) for name, seconds in self.durations.items())
+        if self.first_request_seconds is not None:
+            info['first_request_seconds'] = self.first_request_seconds
+        return info
+
+
+def get_process_age():
+    """
+    Seconds since this process started, 0 if unknown
+    """
+    try:
+        with open('/proc/self/stat') as stat, open('/proc/uptime') as uptime:
+            # field 22 is the start time in clock ticks after boot, the name in field 2 may hold spaces
+            started = int(stat.read().rsplit(')', 1)[1].split()[19]) / os.sysconf('SC_CLK_TCK')
+            return max(float(uptime.read().split()[0]) - started, 0.0)
+    except (OSError, ValueError, IndexError):
+        return 0.0
+
+
+def metric_name(name):
+    return re.sub(r'\W', '_', name)
+
+
+registry = Registry()
+query_samples = deque(maxlen=100)
+boot_timeline = BootTimeline()
+registry.register_gauges('boot', boot_timeline.info)
+
+
+class QueryRecorder(object):
+    """
+    `connection.execute_wrapper` counting queries and their time, keeping the SQL when `sample` is set.
+    """
+
+    def __init__(self, sample=False):
+        self.count = 0
+        self.seconds = 0.0
+        self.queries = [] if sample else None
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - start
+            self.count += 1
+            self.seconds += elapsed
+            if self.queries is not None:
+                self.queries.append({'sql': sql, 'seconds': elapsed})
+
+
+@contextmanager
+def measure(name):
+    """
+    Record wall time, DB query count and DB time of the block as `<name>` metrics.
+    """
+    if not ENABLED:
+        yield
+        return
+
+    recorder = QueryRecorder(sample=QUERY_SAMPLE_RATE and random.random() < QUERY_SAMPLE_RATE)
+    start = time.perf_counter()
+    try:
+        with connection.execute_wrapper(recorder):
+            yield
+    finally:
+        elapsed = time.perf_counter() - start
+        registry.histogram('wall_seconds', name=name).observe(elapsed)
+        registry.histogram('db_queries', COUNT_BUCKETS, name=name).observe(recorder.count)
+        registry.histogram('db_seconds', name=name).observe(recorder.seconds)
+        if recorder.queries is not None:
+            query_samples.append({'name': name, 'seconds': elapsed, 'queries': recorder.queries})
+
+
+def instrument(name):
+    """
+    Decorator recording wall time, DB query count and DB time of every call, see `measure`
+
+    Usage
+    -----
+    @instrument('get_category_hierarchy')
+    def get_category_hierarchy(category_ids):
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with measure(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def external_call(service):
+    """
+    Record the latency of a call to an external service, e.g. `with external_call('dialogflow'):`
+    """
+    if not ENABLED:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        registry.histogram('external_seconds', service=service).observe(time.perf_counter() - start)
+
+
+class InstrumentationMiddleware(object):
+    """
+    Records wall time, DB query count and DB time of every request, labelled with the view name.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not ENABLED:
+            return self.get_response(request)
+
+        recorder = QueryRecorder()
+        start = time.perf_counter()
+        with connection.execute_wrapper(recorder):
+            response = self.get_response(request)
+        elapsed = time.perf_counter() - start
+
+        match = getattr(request, 'resolver_match', None)
+        view = match.view_name if match else 'unresolved'
+        status = '{}xx'.format(response.status_code // 100)
+        registry.histogram('http_request_seconds', view=view, status=status).observe(elapsed)
+        registry.histogram('http_request_db_queries', COUNT_BUCKETS, view=view).observe(recorder.count)
+        registry.histogram('http_request_db_seconds', view=view).observe(recorder.seconds)
+        boot_timeline.record_first_request(elapsed)
+        return response
+
+
+def metrics_view(request):
+    """
+    Metrics in the Prometheus text format, or JSON with `?format=json`. Staff only, plus
+    INSTRUMENTATION_METRICS_ALLOWED_IPS if set.
+    """
+    if not request.user.is_staff and request.META.get('REMOTE_ADDR') not in METRICS_ALLOWED_IPS:
+        return HttpResponseForbidden()
+    if request.GET.get('format') == 'json':
+        return JsonResponse(registry.to_dict())
+    return HttpResponse(registry.to_prometheus(), content_type='text/plain; version=0.0.4')
@@ -1,10 +1,46 @@
-from pinax.eventlog.models import log
+import random
+
+from pinax.eventlog.models import Log
+from django.conf import settings
+from django.core.cache import cache
 from django.utils.deprecation import MiddlewareMixin
 
 from accounts.models import Device
+from django_dialogflow.instrumentation import registry
+from django_dialogflow.write_behind import WriteBehindBuffer
+
+DEVICE_CACHE_KEY = 'device:{key}'
+DEVICE_CACHE_TIMEOUT = 300
+MISSING_DEVICE = 'missing'
+
+
+def get_device(key):
+    """
+    Get the device of `key` from cache, falling back to the database. Missing devices are cached too.
+
+    Returns
+    -------
+    Device or None
+    """
+    cache_key = DEVICE_CACHE_KEY.format(key=key)
+    device = cache.get(cache_key)
+    if device is None:
+        device = Device.objects.filter(key=key).first() or MISSING_DEVICE
+        cache.set(cache_key, device, DEVICE_CACHE_TIMEOUT)
+    return None if device == MISSING_DEVICE else device
 
 
 class RequestLoggerMiddleware(MiddlewareMixin):
+    """
+    Logs matching requests as pinax events. Events are written behind the request in batches by
+    `event_buffer`, only a `sample_rate` share of them is kept. Both are configured by the
+    REQUEST_LOGGER setting, {'sample_rate': 1.0, 'buffer': {...WriteBehindBuffer options}}.
+    """
+    options = getattr(settings, 'REQUEST_LOGGER', {})
+    sample_rate = options.get('sample_rate', 1.0)
+    event_buffer = WriteBehindBuffer(Log, **options.get('buffer', {}))
+    sampled_out = 0
+
     def process_request(self, request):
         extra = {"ip": self.get_client_ip(request)}
         if request.path == "/" or self.is_action_to_log(request.path):
@@ -13,13 +49,23 @@ class RequestLoggerMiddleware(MiddlewareMixin):
             elif request.method == 'GET':
                 extra.update(request.GET)
             if request.user.is_authenticated:
-              log(user=request.user, action=request.path, extra=extra)
+              self.log(user=request.user, action=request.path, extra=extra)
             elif request.user.is_authenticated:
-              try:
-                device = Device.objects.get(key=request.data.get('key'))
-                log(user=device, action=request.path, extra=extra)
-              except Device.DoesNotExist:
-                log(user=request.user, action=request.path, extra=extra )
+              device = get_device(request.data.get('key'))
+              if device is not None:
+                self.log(user=device, action=request.path, extra=extra)
+              else:
+                self.log(user=request.user, action=request.path, extra=extra )
+
+    def log(self, user, action, extra):
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            RequestLoggerMiddleware.sampled_out += 1
+            return
+        self.event_buffer.put(Log(user=user, action=action, extra=extra))
+
+    @classmethod
+    def info(cls):
+        return dict(cls.event_buffer.info(), sample_rate=cls.sample_rate, sampled_out=cls.sampled_out)
 
     def is_action_to_log(self, path):
         actions = ["attendance", "register"]
@@ -35,3 +81,6 @@ class RequestLoggerMiddleware(MiddlewareMixin):
         else:
             ip = request.META.get('REMOTE_ADDR')
         return
+
+
+registry.register_gauges('request_logger', RequestLoggerMiddleware.info)
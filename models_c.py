@@ -0,0 +1,48 @@
+from django.db import models
+
+STATUS_PENDING = 'pending'
+STATUS_CREATING_SUBSCRIPTION = 'creating_subscription'
+STATUS_SENDING_MAIL = 'sending_welcome_mail'
+STATUS_COMPLETED = 'completed'
+STATUS_FAILED = 'failed'
+
+STATUS_CHOICES = (
+    (STATUS_PENDING, 'Pending'),
+    (STATUS_CREATING_SUBSCRIPTION, 'Creating subscription'),
+    (STATUS_SENDING_MAIL, 'Sending welcome mail'),
+    (STATUS_COMPLETED, 'Completed'),
+    (STATUS_FAILED, 'Failed'),
+)
+
+
+class SignupJob(models.Model):
+    """
+    Background part of a signup, see billing.signup_jobs. Created in the transaction of the account,
+    so a job exists for every committed signup even if the worker running it dies.
+    """
+    job_id = models.CharField(max_length=64, unique=True)
+    account = models.ForeignKey('authentication_user.Account', null=True, on_delete=models.SET_NULL,
+                                related_name='+')
+    plan_id = models.CharField(max_length=100, blank=True)
+    # cleared once the subscription was attempted
+    stripe_token = models.CharField(max_length=255, blank=True)
+    status = models.CharField(max_length=32, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    reason = models.TextField(blank=True)
+    message = models.TextField(blank=True)
+    mail_sent = models.BooleanField(null=True)
+    # times a worker picked the job up, more than one when resumed
+    runs = models.PositiveSmallIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        app_label = 'billing'
+        indexes = [models.Index(fields=['status', 'updated_at'])]
+
+    def get_status(self):
+        signup_status = {'job_id': self.job_id, 'status': self.status}
+        if self.status == STATUS_FAILED:
+            signup_status.update(reason=self.reason, message=self.message)
+        elif self.status == STATUS_COMPLETED:
+            signup_status['mail_sent'] = self.mail_sent
+        return signup_status
@@ -1,4 +1,93 @@
-from rest_framework import permissions
+from django.core.cache import cache
+from django.db.models.signals import m2m_changed, pre_delete
+from django.dispatch import receiver
+from rest_framework import filters, permissions
+
+from apps.partner.models import Partner
+
+PARTNER_IDS_CACHE_KEY = 'partner_ids:{user_id}'
+PARTNER_IDS_CACHE_TIMEOUT = 600
+
+
+def get_user_partner_ids(request):
+    """
+    Get the ids of the partners of the request user. Loaded once per request and cached across
+    requests until the user's partner membership changes.
+
+    Returns
+    -------
+    frozenset
+        partner ids
+    """
+    partner_ids = getattr(request, '_partner_ids', None)
+    if partner_ids is None:
+        cache_key = PARTNER_IDS_CACHE_KEY.format(user_id=request.user.id)
+        partner_ids = cache.get(cache_key)
+        if partner_ids is None:
+            partner_ids = frozenset(request.user.partners.values_list('id', flat=True))
+            cache.set(cache_key, partner_ids, PARTNER_IDS_CACHE_TIMEOUT)
+        request._partner_ids = partner_ids
+    return partner_ids
+
+
+def invalidate_user_partner_ids(user_ids):
+    cache.delete_many([PARTNER_IDS_CACHE_KEY.format(user_id=user_id) for user_id in user_ids])
+
+
+@receiver(m2m_changed, sender=Partner.users.through)
+def partner_users_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if reverse:
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            invalidate_user_partner_ids([instance.pk])
+    elif action in ('post_add', 'post_remove'):
+        invalidate_user_partner_ids(pk_set)
+    elif action == 'pre_clear':
+        invalidate_user_partner_ids(instance.users.values_list('pk', flat=True))
+
+
+@receiver(pre_delete, sender=Partner)
+def partner_deleted(sender, instance, **kwargs):
+    invalidate_user_partner_ids(instance.users.values_list('pk', flat=True))
+
+
+def has_partner_access(request, partner_id):
+    try:
+        return int(partner_id) in get_user_partner_ids(request)
+    except (TypeError, ValueError):
+        return False
+
+
+def filter_partner_queryset(request, queryset, field='pk'):
+    """
+    Restrict `queryset` to rows whose `field` is a partner of the request user, staff see everything.
+
+    Parameters
+    ----------
+    request: Request
+    queryset: QuerySet
+    field: str
+        lookup of the partner id, e.g. 'pk' for partners or 'partner_id' for partner owned rows
+
+    Returns
+    -------
+    QuerySet
+    """
+    user = request.user
+    if not user.is_authenticated:
+        return queryset.none()
+    if user.is_superuser or user.is_staff:
+        return queryset
+    return queryset.filter(**{'{}__in'.format(field): get_user_partner_ids(request)})
+
+
+class PartnerFilterBackend(filters.BaseFilterBackend):
+    """
+    Filter list endpoints down to the request user's partners, the bulk form of ClosePartnerPermission.
+    Set `partner_lookup_field` on the view for models other than Partner.
+    """
+
+    def filter_queryset(self, request, queryset, view):
+        return filter_partner_queryset(request, queryset, getattr(view, 'partner_lookup_field', 'pk'))
 
 
 class ClosePartnerPermission(permissions.BasePermission):
@@ -9,6 +98,8 @@ class ClosePartnerPermission(permissions.BasePermission):
             return False
         if user.is_superuser or user.is_staff:
             return True
+        if isinstance(obj, Partner):
+            return obj.pk in get_user_partner_ids(request)
         if obj.users.filter(pk=user.id).exists():
             return True
         return False
@@ -21,7 +112,7 @@ class HasPartnerPermission(permissions.BasePermission):
         partner_id = request.data.get('partner') or view.kwargs.get('partner_id') or request.GET.get('partner_id')
         if not partner_id:
             return False
-        return request.user.partners.filter(id=partner_id).exists()
+        return has_partner_access(request, partner_id)
 
 class HasSuperuserPermission(permissions.BasePermission):
     message = 'Only Works for superuser.'
@@ -30,4 +121,4 @@ class HasSuperuserPermission(permissions.BasePermission):
         if request.user.is_superuser:
             return True
         else:
-            return False 
\ No newline at end of file
+            return False
@@ -1,20 +1,537 @@
+import logging
+import time
+from array import array
+from contextlib import contextmanager
+from collections import OrderedDict, namedtuple
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
 from django.db import connection
-from apps.catalogue.models import Product
+from django.utils import timezone
 from apps.partner.utils import ids_to_str
 
 
+logger = logging.getLogger(__name__)
+
+NOVELTY_DAYS = 60
+
+LAST_RUN_CACHE_KEY = 'product_score:last_run'
+BOUNDS_CACHE_KEY = 'product_score:bounds'
+RANKING_VERSION_CACHE_KEY = 'product_ranking:version'
+RANKING_CACHE_KEY = 'product_ranking:{version}:{scope}:{scope_id}'
+
+STATS_TABLE = 'catalogue_productstats'
+STAGING_STATS_TABLE = 'catalogue_productstats_staging'
+
+FETCH_CHUNK_SIZE = 10000
+SCORE_CHUNK_SIZE = 5000
+# ids per IN (...) list
+BATCH_SIZE = 1000
+
+RANKING_SIZE = 500
+RANKING_TIMEOUT = 2 * 24 * 60 * 60
+
+ScoreWeights = namedtuple('ScoreWeights', ['order', 'favourite', 'novelty'])
+
+DEFAULT_SCORE_WEIGHTS = ScoreWeights(order=0.43, favourite=0.43, novelty=0.14)
+
+
 UPDATE_PRODUCT_SCORE = '''
 UPDATE catalogue_product p,
     catalogue_productstats as ps
 SET 
-     p.score = 0.43 * IFNULL(ps.normalized_order_rate, 0) + 0.43 * IFNULL(ps.normalized_favourite_rate, 0) +
-     0.14 * IFNULL(ps.normalized_novelty_rate, 0)
+     p.score = {weights.order} * IFNULL(ps.normalized_order_rate, 0) +
+     {weights.favourite} * IFNULL(ps.normalized_favourite_rate, 0) +
+     {weights.novelty} * IFNULL(ps.normalized_novelty_rate, 0)
 WHERE
     ps.product_id in ({product_ids}) and p.id = ps.product_id
 '''
 
+CHANGED_PRODUCT_IDS = '''
+SELECT l.product_id
+FROM order_line l
+    INNER JOIN order_order o ON o.id = l.order_id
+WHERE o.date_placed >= %(since)s AND l.product_id IS NOT NULL
+UNION
+SELECT f.product_id
+FROM catalogue_favouriteproduct f
+WHERE f.date_created >= %(since)s
+UNION
+SELECT p.id
+FROM catalogue_product p
+WHERE p.published = 1 AND p.date_created >= %(novelty_start)s
+'''
+
+CHANGED_STATS_MIN_MAX = '''
+SELECT
+    MIN(order_rate), MAX(order_rate),
+    MIN(favourite_rate), MAX(favourite_rate),
+    MIN(novelty_rate), MAX(novelty_rate)
+FROM catalogue_productstats
+WHERE product_id in ({product_ids})
+'''
+
+DELETE_PRODUCT_STATS = '''
+DELETE FROM catalogue_productstats WHERE product_id in ({product_ids})
+'''
+
+INSERT_PRODUCT_STATS = '''
+INSERT INTO catalogue_productstats (product_id, order_rate, favourite_rate, novelty_rate)
+SELECT
+    p.id,
+    (SELECT IFNULL(SUM(l.quantity), 0) FROM order_line l WHERE l.product_id = p.id),
+    (SELECT COUNT(*) FROM catalogue_favouriteproduct f WHERE f.product_id = p.id),
+    LEAST(DATEDIFF(NOW(), p.date_created), {novelty_days})
+FROM catalogue_product p
+WHERE p.published = 1 AND p.id in ({product_ids})
+'''
+
+UPDATE_ALL_PRODUCT_SCORE = '''
+UPDATE catalogue_product p
+    INNER JOIN catalogue_productstats ps ON p.id = ps.product_id
+SET
+     p.score = {weights.order} * IFNULL(ps.normalized_order_rate, 0) +
+     {weights.favourite} * IFNULL(ps.normalized_favourite_rate, 0) +
+     {weights.novelty} * IFNULL(ps.normalized_novelty_rate, 0)
+WHERE
+    p.published = 1 AND p.id > %(lower)s AND p.id <= %(upper)s
+'''
+
+DROP_STAGING_STATS = '''
+DROP TABLE IF EXISTS catalogue_productstats_staging
+'''
+
+CREATE_STAGING_STATS = '''
+CREATE TABLE catalogue_productstats_staging LIKE catalogue_productstats
+'''
+
+# LIKE copies columns and indexes but not foreign keys, they are read from the live table and added
+STATS_FOREIGN_KEYS = '''
+SELECT k.CONSTRAINT_NAME, k.COLUMN_NAME, k.REFERENCED_TABLE_NAME, k.REFERENCED_COLUMN_NAME,
+    r.UPDATE_RULE, r.DELETE_RULE
+FROM information_schema.KEY_COLUMN_USAGE k
+    INNER JOIN information_schema.REFERENTIAL_CONSTRAINTS r
+        ON r.CONSTRAINT_SCHEMA = k.CONSTRAINT_SCHEMA AND r.CONSTRAINT_NAME = k.CONSTRAINT_NAME
+WHERE k.TABLE_SCHEMA = DATABASE() AND k.TABLE_NAME = 'catalogue_productstats'
+    AND k.REFERENCED_TABLE_NAME IS NOT NULL
+ORDER BY k.CONSTRAINT_NAME, k.ORDINAL_POSITION
+'''
+
+ADD_STAGING_FOREIGN_KEY = '''
+ALTER TABLE catalogue_productstats_staging
+    ADD CONSTRAINT `{name}` FOREIGN KEY ({columns}) REFERENCES `{table}` ({referenced_columns})
+    ON UPDATE {update_rule} ON DELETE {delete_rule}
+'''
+
+# foreign key names are unique per schema, so staging constraints alternate between the plain name
+# and the name with this suffix
+STAGING_FOREIGN_KEY_SUFFIX = '_stg'
+
+SWAP_STATS_TABLES = '''
+RENAME TABLE
+    catalogue_productstats TO catalogue_productstats_old,
+    catalogue_productstats_staging TO catalogue_productstats
+'''
+
+DROP_OLD_STATS = '''
+DROP TABLE IF EXISTS catalogue_productstats_old
+'''
+
+NEXT_PRODUCT_ID_RANGE = '''
+SELECT MAX(chunk.id)
+FROM (
+    SELECT id FROM catalogue_product WHERE published = 1 AND id > %(lower)s ORDER BY id LIMIT %(limit)s
+) AS chunk
+'''
+
+SELECT_PRODUCT_STATS = '''
+SELECT product_id, order_rate, favourite_rate, novelty_rate FROM catalogue_productstats
+'''
+
+CREATE_SCORE_LOAD = '''
+CREATE TEMPORARY TABLE IF NOT EXISTS catalogue_productscore_load (
+    product_id INT NOT NULL PRIMARY KEY,
+    normalized_order_rate DOUBLE,
+    normalized_favourite_rate DOUBLE,
+    normalized_novelty_rate DOUBLE,
+    score DOUBLE NOT NULL
+)
+'''
+
+INSERT_SCORE_LOAD = '''
+INSERT INTO catalogue_productscore_load
+    (product_id, normalized_order_rate, normalized_favourite_rate, normalized_novelty_rate, score)
+VALUES (%s, %s, %s, %s, %s)
+'''
+
+UPDATE_STATS_FROM_SCORE_LOAD = '''
+UPDATE catalogue_productstats ps
+    INNER JOIN catalogue_productscore_load s ON s.product_id = ps.product_id
+SET
+    ps.normalized_order_rate = s.normalized_order_rate,
+    ps.normalized_favourite_rate = s.normalized_favourite_rate,
+    ps.normalized_novelty_rate = s.normalized_novelty_rate
+'''
+
+UPDATE_PRODUCT_SCORE_FROM_SCORE_LOAD = '''
+UPDATE catalogue_product p
+    INNER JOIN catalogue_productscore_load s ON s.product_id = p.id
+SET
+    p.score = s.score
+WHERE
+    p.published = 1 AND p.id > %(lower)s AND p.id <= %(upper)s
+'''
+
+NORMALIZE_PRODUCT_STATS = '''
+UPDATE catalogue_productstats
+SET
+    normalized_order_rate = (order_rate - {min_order_rate}) / {order_rate_divisor},
+    normalized_favourite_rate = (favourite_rate - {min_favourite_rate}) / {favourite_rate_divisor},
+    normalized_novelty_rate = ({max_novelty_rate} - novelty_rate) / {novelty_rate_divisor}
+WHERE product_id in ({product_ids})
+'''
+
+# top `size` published products per scope, best first, `scope_filter` narrows the ranked scopes
+RANKED_CATEGORY_PRODUCTS = '''
+SELECT category_id, product_id
+FROM (
+    SELECT pc.category_id, p.id AS product_id,
+        ROW_NUMBER() OVER (PARTITION BY pc.category_id ORDER BY p.score DESC, p.id) AS position
+    FROM catalogue_product p
+        INNER JOIN catalogue_productcategory pc ON pc.product_id = p.id
+    WHERE p.published = 1{scope_filter}
+) ranked
+WHERE position <= {size}
+ORDER BY category_id, position
+'''
+
+RANKED_CITY_PRODUCTS = '''
+SELECT city_id, product_id
+FROM (
+    SELECT pa.city_id, p.id AS product_id,
+        ROW_NUMBER() OVER (PARTITION BY pa.city_id ORDER BY p.score DESC, p.id) AS position
+    FROM catalogue_product p
+        INNER JOIN (
+            SELECT DISTINCT sr.product_id, partner.city_id
+            FROM partner_stockrecord sr
+                INNER JOIN partner_partner partner ON partner.id = sr.partner_id
+            WHERE partner.city_id IS NOT NULL
+        ) pa ON pa.product_id = p.id
+    WHERE p.published = 1{scope_filter}
+) ranked
+WHERE position <= {size}
+ORDER BY city_id, position
+'''
+
+CHANGED_PRODUCT_CATEGORIES = '''
+SELECT DISTINCT category_id
+FROM catalogue_productcategory
+WHERE product_id IN ({product_ids})
+'''
+
+CHANGED_PRODUCT_CITIES = '''
+SELECT DISTINCT pa.city_id
+FROM partner_stockrecord sr
+    INNER JOIN partner_partner pa ON pa.id = sr.partner_id
+WHERE sr.product_id IN ({product_ids}) AND pa.city_id IS NOT NULL
+'''
 
-def update_product_score():
+# scope, ranking query, column of the scope id in it, query of the scopes of changed products
+RANKING_QUERIES = (
+    ('category', RANKED_CATEGORY_PRODUCTS, 'pc.category_id', CHANGED_PRODUCT_CATEGORIES),
+    ('city', RANKED_CITY_PRODUCTS, 'pa.city_id', CHANGED_PRODUCT_CITIES),
+)
+
+
+def get_normalize_params(bounds):
+    """
+    Helper to form the PRODUCT_NORMALIZE_STATS format params from min/max bounds
+
+    Parameters
+    ----------
+    bounds: tuple
+        (min_order_rate, max_order_rate, min_favourite_rate, max_favourite_rate, min_novelty_rate, max_novelty_rate)
+
+    Returns
+    -------
+    dict
+        {'min_order_rate': '', 'order_rate_divisor': '', ...}
+    """
+    (min_order_rate, max_order_rate,
+     min_favourite_rate, max_favourite_rate,
+     min_novelty_rate, max_novelty_rate) = bounds
+
+    return dict(
+        min_order_rate=min_order_rate, min_favourite_rate=min_favourite_rate,
+        max_novelty_rate=max_novelty_rate,
+        order_rate_divisor=(max_order_rate - min_order_rate) or max_order_rate or 1,
+        favourite_rate_divisor=(max_favourite_rate - min_favourite_rate) or max_favourite_rate or 1,
+        novelty_rate_divisor=((NOVELTY_DAYS - min_novelty_rate) - (NOVELTY_DAYS - max_novelty_rate))
+        or max_novelty_rate or 1)
+
+
+def on_staging(sql):
+    """
+    Point a productstats statement at the staging table.
+    """
+    return sql.replace(STATS_TABLE, STAGING_STATS_TABLE)
+
+
+def create_staging_stats(cursor):
+    """
+    Create an empty staging table from the current schema of the live productstats table.
+
+    It is recreated on every run, so a staging table left by an interrupted run or created before a
+    migration is never swapped in. Foreign keys are copied from the live table; the original constraint
+    has to exist there, tables swapped in by runs which did not copy them need it restored once.
+    """
+    cursor.execute(DROP_OLD_STATS)
+    cursor.execute(DROP_STAGING_STATS)
+    cursor.execute(CREATE_STAGING_STATS)
+
+    cursor.execute(STATS_FOREIGN_KEYS)
+    foreign_keys = OrderedDict()
+    for name, column, table, referenced_column, update_rule, delete_rule in cursor.fetchall():
+        foreign_key = foreign_keys.setdefault(name, {
+            'columns': [], 'table': table, 'referenced_columns': [],
+            'update_rule': update_rule, 'delete_rule': delete_rule,
+        })
+        foreign_key['columns'].append('`{}`'.format(column))
+        foreign_key['referenced_columns'].append('`{}`'.format(referenced_column))
+
+    for name, foreign_key in foreign_keys.items():
+        if name.endswith(STAGING_FOREIGN_KEY_SUFFIX):
+            staging_name = name[:-len(STAGING_FOREIGN_KEY_SUFFIX)]
+        else:
+            staging_name = name + STAGING_FOREIGN_KEY_SUFFIX
+        cursor.execute(ADD_STAGING_FOREIGN_KEY.format(
+            name=staging_name,
+            columns=', '.join(foreign_key['columns']),
+            table=foreign_key['table'],
+            referenced_columns=', '.join(foreign_key['referenced_columns']),
+            update_rule=foreign_key['update_rule'],
+            delete_rule=foreign_key['delete_rule'],
+        ))
+
+
+@contextmanager
+def timed(timings, phase):
+    """
+    Record the seconds spent in the block under `phase` in `timings`.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[phase] = time.perf_counter() - start
+
+
+def merge_bounds(bounds, changed_bounds):
+    """
+    Widen min/max bounds with the bounds of recomputed rows.
+
+    Parameters
+    ----------
+    bounds: tuple
+        current (min, max) pairs of order, favourite and novelty rate
+    changed_bounds: tuple
+        (min, max) pairs of the recomputed rows, None values are ignored
+
+    Returns
+    -------
+    tuple
+        merged bounds in the same layout
+    """
+    merged = []
+    for index, (current, changed) in enumerate(zip(bounds, changed_bounds)):
+        if changed is None:
+            merged.append(current)
+        elif index % 2 == 0:
+            merged.append(min(current, changed))
+        else:
+            merged.append(max(current, changed))
+    return tuple(merged)
+
+
+def iter_product_id_ranges(cursor, chunk_size):
+    """
+    Walk published product ids with keyset pagination, no id list is held in Python.
+
+    Yields
+    ------
+    tuple
+        (lower, upper) bounds of a chunk of at most `chunk_size` published products, lower exclusive
+    """
+    lower = 0
+    while True:
+        cursor.execute(NEXT_PRODUCT_ID_RANGE, {'lower': lower, 'limit': chunk_size})
+        upper = cursor.fetchone()[0]
+        if upper is None:
+            return
+        yield lower, upper
+        lower = upper
+
+
+def execute_in_id_ranges(cursor, sql, chunk_size=None, throttle=None):
+    """
+    Run a product update restricted by `p.id > %(lower)s AND p.id <= %(upper)s` over all published
+    products, one keyset chunk at a time, sleeping `throttle` seconds between chunks.
+
+    Defaults come from the PRODUCT_SCORE_CHUNK_SIZE and PRODUCT_SCORE_CHUNK_THROTTLE settings.
+    """
+    chunk_size = chunk_size or getattr(settings, 'PRODUCT_SCORE_CHUNK_SIZE', SCORE_CHUNK_SIZE)
+    if throttle is None:
+        throttle = getattr(settings, 'PRODUCT_SCORE_CHUNK_THROTTLE', 0)
+
+    for index, (lower, upper) in enumerate(iter_product_id_ranges(cursor, chunk_size)):
+        if index and throttle:
+            time.sleep(throttle)
+        cursor.execute(sql, {'lower': lower, 'upper': upper})
+
+
+def score_product_stats(order_rate, favourite_rate, novelty_rate, weights=DEFAULT_SCORE_WEIGHTS):
+    """
+    Normalize raw product stats and score them with NumPy, mirroring PRODUCT_NORMALIZE_STATS and
+    UPDATE_PRODUCT_SCORE. Needs no database, so weight sets can be compared offline.
+
+    Parameters
+    ----------
+    order_rate: array-like
+        raw order rate per product, NaN for NULL
+    favourite_rate: array-like
+        raw favourite rate per product, NaN for NULL
+    novelty_rate: array-like
+        raw novelty rate per product, NaN for NULL
+    weights: ScoreWeights
+        weights of the normalized order, favourite and novelty rate
+
+    Returns
+    -------
+    tuple
+        (bounds, normalized_order_rate, normalized_favourite_rate, normalized_novelty_rate, score)
+    """
+    import numpy as np
+
+    order_rate = np.asarray(order_rate, dtype=float)
+    favourite_rate = np.asarray(favourite_rate, dtype=float)
+    novelty_rate = np.asarray(novelty_rate, dtype=float)
+    if not order_rate.size:
+        return None, order_rate, favourite_rate, novelty_rate, np.zeros(0)
+
+    bounds = tuple(
+        float(bound) for rate in (order_rate, favourite_rate, novelty_rate)
+        for bound in (np.nanmin(rate), np.nanmax(rate))
+    )
+    params = get_normalize_params(bounds)
+
+    normalized_order_rate = (order_rate - params['min_order_rate']) / params['order_rate_divisor']
+    normalized_favourite_rate = (favourite_rate - params['min_favourite_rate']) / params['favourite_rate_divisor']
+    normalized_novelty_rate = (params['max_novelty_rate'] - novelty_rate) / params['novelty_rate_divisor']
+
+    score = (weights.order * np.nan_to_num(normalized_order_rate) +
+             weights.favourite * np.nan_to_num(normalized_favourite_rate) +
+             weights.novelty * np.nan_to_num(normalized_novelty_rate))
+
+    return bounds, normalized_order_rate, normalized_favourite_rate, normalized_novelty_rate, score
+
+
+def fetch_product_stats(cursor, table=STATS_TABLE, chunk_size=FETCH_CHUNK_SIZE):
+    """
+    Stream the raw productstats rows into NumPy arrays.
+
+    Returns
+    -------
+    tuple
+        (product_ids, order_rate, favourite_rate, novelty_rate), NULL rates are NaN
+    """
+    import numpy as np
+
+    cursor.execute(SELECT_PRODUCT_STATS.replace(STATS_TABLE, table))
+    chunks = []
+    rows = cursor.fetchmany(chunk_size)
+    while rows:
+        chunks.append(np.array(rows, dtype=float))
+        rows = cursor.fetchmany(chunk_size)
+
+    stats = np.concatenate(chunks) if chunks else np.empty((0, 4))
+    return stats[:, 0].astype(np.int64), stats[:, 1], stats[:, 2], stats[:, 3]
+
+
+class SqlScoringBackend(object):
+    """
+    Normalizes and scores inside the database with PRODUCT_NORMALIZE_STATS and UPDATE_ALL_PRODUCT_SCORE.
+    """
+
+    def __init__(self, weights=DEFAULT_SCORE_WEIGHTS, chunk_size=None, throttle=None):
+        self.weights = weights
+        self.chunk_size = chunk_size
+        self.throttle = throttle
+
+    def normalize(self, cursor, table=STATS_TABLE):
+        cursor.execute(PRODUCT_STATS_MIN_MAX.replace(STATS_TABLE, table))
+        bounds = cursor.fetchone()
+        cursor.execute(PRODUCT_NORMALIZE_STATS.replace(STATS_TABLE, table).format(**get_normalize_params(bounds)))
+        return bounds
+
+    def score(self, cursor):
+        execute_in_id_ranges(cursor, UPDATE_ALL_PRODUCT_SCORE.format(weights=self.weights),
+                             self.chunk_size, self.throttle)
+
+
+class NumpyScoringBackend(SqlScoringBackend):
+    """
+    Streams the raw stats out, normalizes and scores them with `score_product_stats` and writes the
+    results back through a temporary load table filled with executemany, followed by join updates.
+    """
+
+    def normalize(self, cursor, table=STATS_TABLE):
+        product_ids, order_rate, favourite_rate, novelty_rate = fetch_product_stats(cursor, table)
+        bounds, *normalized, score = score_product_stats(order_rate, favourite_rate, novelty_rate, self.weights)
+
+        cursor.execute(CREATE_SCORE_LOAD)
+        cursor.execute('TRUNCATE TABLE catalogue_productscore_load')
+        rows = [
+            tuple(None if value != value else value for value in row)
+            for row in zip(product_ids.tolist(), *(values.tolist() for values in normalized), score.tolist())
+        ]
+        for i in range(0, len(rows), FETCH_CHUNK_SIZE):
+            cursor.executemany(INSERT_SCORE_LOAD, rows[i:i + FETCH_CHUNK_SIZE])
+        cursor.execute(UPDATE_STATS_FROM_SCORE_LOAD.replace(STATS_TABLE, table))
+        return bounds
+
+    def score(self, cursor):
+        execute_in_id_ranges(cursor, UPDATE_PRODUCT_SCORE_FROM_SCORE_LOAD, self.chunk_size, self.throttle)
+
+
+SCORING_BACKENDS = {
+    'sql': SqlScoringBackend,
+    'numpy': NumpyScoringBackend,
+}
+
+
+def get_scoring_backend(name=None, weights=None):
+    """
+    Build the scoring backend, defaults come from the PRODUCT_SCORE_BACKEND and PRODUCT_SCORE_WEIGHTS settings.
+
+    Parameters
+    ----------
+    name: str
+        'sql' or 'numpy'
+    weights: ScoreWeights
+
+    Returns
+    -------
+    SqlScoringBackend
+    """
+    name = name or getattr(settings, 'PRODUCT_SCORE_BACKEND', 'sql')
+    if weights is None:
+        weights = getattr(settings, 'PRODUCT_SCORE_WEIGHTS', None)
+        weights = ScoreWeights(**weights) if weights else DEFAULT_SCORE_WEIGHTS
+    return SCORING_BACKENDS[name](weights)
+
+
+def update_product_score(incremental=False, backend=None):
 
     """
     calculating the score of products
@@ -25,32 +542,257 @@ def update_product_score():
     4. calculating min, max of order_sum, favourite_count and novelty.
     5. normalize order_sum, favourite_count and novelty.
     6. calculating score of products using order_sum, favourite_count and novelty.
+    7. materialize the top products per category and city, see `materialize_product_rankings`.
+
+    Stats are built into a staging table which is swapped in with a single RENAME, so the live
+    productstats table is never empty or half computed, then scores are written with join updates over
+    keyset chunks of published products, see `execute_in_id_ranges`.
+
+    With `incremental` only products changed since the last run are rescored,
+    see `update_changed_product_score`. Normalizing and scoring is done by `backend`,
+    see `get_scoring_backend`.
+
+    Returns
+    -------
+    dict
+        seconds spent per phase, {'insert': 0.1, 'order_rate': 0.2, ...}
     """
 
+    backend = backend or get_scoring_backend()
+
+    if incremental and cache.get(LAST_RUN_CACHE_KEY):
+        return update_changed_product_score(backend)
+
+    started_at = timezone.now()
+    timings = {}
+
     with connection.cursor() as cursor:
-        cursor.execute('TRUNCATE TABLE catalogue_productstats')
+        create_staging_stats(cursor)
+
+        with timed(timings, 'insert'):
+            cursor.execute(on_staging(INSERT_PRODUCT))
+        with timed(timings, 'order_rate'):
+            cursor.execute(on_staging(UPDATE_ORDER_RATE))
+        with timed(timings, 'favourite_rate'):
+            cursor.execute(on_staging(UPDATE_FAVOURITE_RATE))
+        with timed(timings, 'novelty'):
+            cursor.execute(on_staging(UPDATE_NOVELTY_RATE))
+
+        with timed(timings, 'normalize'):
+            bounds = backend.normalize(cursor, table=STAGING_STATS_TABLE)
+
+        with timed(timings, 'swap'):
+            cursor.execute(SWAP_STATS_TABLES)
+            cursor.execute(DROP_OLD_STATS)
+
+        with timed(timings, 'score'):
+            backend.score(cursor)
+
+        cache.set_many({LAST_RUN_CACHE_KEY: started_at, BOUNDS_CACHE_KEY: bounds}, None)
+        update_rankings(cursor, timings, started_at.timestamp())
+
+    logger.info('product score updated in %.2fs: %s', sum(timings.values()), timings)
+    return timings
+
+
+def update_changed_product_score(backend=None):
+    """
+    Rescore only the products whose order, favourite or novelty stats changed since the last run.
+
+    1. collect products with new order lines, new favourites or still inside the novelty window.
+    2. recompute the productstats rows of those products only.
+    3. update the min/max bounds from the recomputed rows; if a changed row held a bound, re-read
+       the bounds from the table as it may have shrunk.
+    4. if the bounds are unchanged normalize and score the changed rows only, otherwise
+       renormalize and rescore every product.
+    5. materialize the top products per category and city again.
+
+    Removed favourites leave no trace to track, they are picked up by the next full run.
+    """
+    backend = backend or get_scoring_backend()
+    last_run = cache.get(LAST_RUN_CACHE_KEY)
+    bounds = cache.get(BOUNDS_CACHE_KEY)
+    if not last_run or bounds is None:
+        return update_product_score(backend=backend)
+
+    started_at = timezone.now()
+    timings = {}
+    bounds_moved = False
 
     with connection.cursor() as cursor:
-        cursor.execute(INSERT_PRODUCT)
-        cursor.execute(UPDATE_ORDER_RATE)
-        cursor.execute(UPDATE_FAVOURITE_RATE)
-        cursor.execute(UPDATE_NOVELTY_RATE)
-
-        cursor.execute(PRODUCT_STATS_MIN_MAX)
-
-        (min_order_rate, max_order_rate,
-         min_favourite_rate, max_favourite_rate,
-         min_novelty_rate, max_novelty_rate) = cursor.fetchone()
-
-        cursor.execute(PRODUCT_NORMALIZE_STATS.format(
-            min_order_rate=min_order_rate, min_favourite_rate=min_favourite_rate,
-            max_novelty_rate=max_novelty_rate,
-            order_rate_divisor=(max_order_rate - min_order_rate) or max_order_rate or 1,
-            favourite_rate_divisor=(max_favourite_rate - min_favourite_rate) or max_favourite_rate or 1,
-            novelty_rate_divisor=((60 - min_novelty_rate) - (60 - max_novelty_rate)) or max_novelty_rate or 1))
-
-        product_ids = Product.objects.filter(published=True).values_list('pk', flat=True)
-        total_products = len(product_ids)
-        for i in range(0, total_products, BATCH_SIZE):
-            cursor.execute(UPDATE_PRODUCT_SCORE.format(
-                product_ids=ids_to_str(product_ids[i:min(i + BATCH_SIZE, total_products)])))
+        with timed(timings, 'changed'):
+            # novelty of products created one day before the window still moves onto the cap
+            cursor.execute(CHANGED_PRODUCT_IDS, {
+                'since': last_run,
+                'novelty_start': started_at - timedelta(days=NOVELTY_DAYS + 1),
+            })
+            changed_product_ids = [row[0] for row in cursor.fetchall()]
+
+        with timed(timings, 'rescore'):
+            for i in range(0, len(changed_product_ids), BATCH_SIZE):
+                product_ids = ids_to_str(changed_product_ids[i:i + BATCH_SIZE])
+
+                if not bounds_moved:
+                    cursor.execute(CHANGED_STATS_MIN_MAX.format(product_ids=product_ids))
+                    old_bounds = cursor.fetchone()
+
+                cursor.execute(DELETE_PRODUCT_STATS.format(product_ids=product_ids))
+                cursor.execute(INSERT_PRODUCT_STATS.format(product_ids=product_ids, novelty_days=NOVELTY_DAYS))
+
+                if bounds_moved:
+                    continue
+
+                if any(old is not None and old == bound for old, bound in zip(old_bounds, bounds)):
+                    cursor.execute(PRODUCT_STATS_MIN_MAX)
+                    new_bounds = cursor.fetchone()
+                else:
+                    cursor.execute(CHANGED_STATS_MIN_MAX.format(product_ids=product_ids))
+                    new_bounds = merge_bounds(bounds, cursor.fetchone())
+
+                if new_bounds != bounds:
+                    bounds_moved = True
+                    continue
+
+                cursor.execute(NORMALIZE_PRODUCT_STATS.format(product_ids=product_ids, **get_normalize_params(bounds)))
+                cursor.execute(UPDATE_PRODUCT_SCORE.format(product_ids=product_ids, weights=backend.weights))
+
+        if bounds_moved:
+            with timed(timings, 'normalize'):
+                bounds = backend.normalize(cursor)
+            with timed(timings, 'score'):
+                backend.score(cursor)
+
+        cache.set_many({LAST_RUN_CACHE_KEY: started_at, BOUNDS_CACHE_KEY: bounds}, None)
+        # moved bounds rescore every product, otherwise only the scopes of changed products move
+        update_rankings(cursor, timings, started_at.timestamp(),
+                        changed_product_ids=None if bounds_moved else changed_product_ids)
+
+    logger.info('product score updated incrementally for %d products in %.2fs: %s',
+                len(changed_product_ids), sum(timings.values()), timings)
+    return timings
+
+
+def update_rankings(cursor, timings, version, changed_product_ids=None):
+    """
+    `materialize_product_rankings` as the last step of a scoring run. Scores and the bookkeeping of
+    the run are saved before, so a failure here is logged and leaves the previous rankings served.
+    """
+    try:
+        with timed(timings, 'rankings'):
+            materialize_product_rankings(cursor, version, changed_product_ids=changed_product_ids)
+    except Exception:
+        logger.exception('materializing product rankings failed, the previous rankings stay in use')
+
+
+def iter_rankings(cursor, sql, chunk_size=FETCH_CHUNK_SIZE):
+    """
+    Group rows of (scope id, product id) ordered by scope id and rank into rankings.
+
+    Yields
+    ------
+    tuple
+        (scope id, array of product ids, best first)
+    """
+    cursor.execute(sql)
+    scope_id, ranking = None, None
+    rows = cursor.fetchmany(chunk_size)
+    while rows:
+        for row in rows:
+            if ranking is None or row[0] != scope_id:
+                if ranking is not None:
+                    yield scope_id, ranking
+                scope_id, ranking = row[0], array('q')
+            ranking.append(row[1])
+        rows = cursor.fetchmany(chunk_size)
+    if ranking is not None:
+        yield scope_id, ranking
+
+
+def get_changed_scope_ids(cursor, sql, changed_product_ids):
+    scope_ids = set()
+    for i in range(0, len(changed_product_ids), BATCH_SIZE):
+        cursor.execute(sql.format(product_ids=ids_to_str(changed_product_ids[i:i + BATCH_SIZE])))
+        scope_ids.update(row[0] for row in cursor.fetchall())
+    return sorted(scope_ids)
+
+
+def materialize_product_rankings(cursor, version, size=None, timeout=None, changed_product_ids=None):
+    """
+    Store the top `size` published products by score of every category and city in cache. Only the
+    top `size` rows per scope are selected, ranked in SQL with ROW_NUMBER(), which needs MySQL 8.
+
+    Rankings are written under keys of a new `version` first and the version key is switched last,
+    so readers see either the previous or the new rankings, never a mix. Superseded versions expire
+    after `timeout` seconds. Defaults come from the PRODUCT_RANKING_SIZE and PRODUCT_RANKING_TIMEOUT
+    settings, the timeout should outlast the interval between scoring runs.
+
+    With `changed_product_ids` only the categories and cities of these products are ranked again and
+    replaced in the current version, each ranking is replaced as a whole. Without a current version
+    everything is ranked under `version`.
+
+    Returns
+    -------
+    int
+        number of rankings stored
+    """
+    size = size or getattr(settings, 'PRODUCT_RANKING_SIZE', RANKING_SIZE)
+    timeout = timeout or getattr(settings, 'PRODUCT_RANKING_TIMEOUT', RANKING_TIMEOUT)
+
+    current_version = cache.get(RANKING_VERSION_CACHE_KEY) if changed_product_ids is not None else None
+    if current_version is None:
+        rankings = {}
+        for scope, sql, _, _ in RANKING_QUERIES:
+            for scope_id, ranking in iter_rankings(cursor, sql.format(scope_filter='', size=int(size))):
+                rankings[RANKING_CACHE_KEY.format(version=version, scope=scope, scope_id=scope_id)] = ranking
+
+        cache.set_many(rankings, timeout)
+        cache.set(RANKING_VERSION_CACHE_KEY, version, timeout)
+        return len(rankings)
+
+    rankings = {}
+    for scope, sql, scope_column, changed_sql in RANKING_QUERIES:
+        scope_ids = get_changed_scope_ids(cursor, changed_sql, changed_product_ids)
+        for i in range(0, len(scope_ids), BATCH_SIZE):
+            batch = scope_ids[i:i + BATCH_SIZE]
+            # scopes left without published products get an empty ranking
+            batch_rankings = dict.fromkeys(batch, array('q'))
+            scope_filter = ' AND {} IN ({})'.format(scope_column, ids_to_str(batch))
+            batch_rankings.update(iter_rankings(cursor, sql.format(scope_filter=scope_filter, size=int(size))))
+            for scope_id, ranking in batch_rankings.items():
+                rankings[RANKING_CACHE_KEY.format(version=current_version, scope=scope, scope_id=scope_id)] = ranking
+
+    cache.set_many(rankings, timeout)
+    return len(rankings)
+
+
+def get_top_products(category_id=None, city_id=None, offset=0, limit=20):
+    """
+    Page through the precomputed ranking of a category or a city, no sort query is run.
+
+    Parameters
+    ----------
+    category_id: int
+        rank the products of this category
+    city_id: int
+        rank the products stocked by partners of this city, used when no `category_id` is given
+    offset: int
+    limit: int
+
+    Returns
+    -------
+    list or None
+        product ids best first, None if no ranking is materialized and the caller should fall back
+        to ordering by score
+    """
+    version = cache.get(RANKING_VERSION_CACHE_KEY)
+    if version is None:
+        return None
+
+    if category_id is not None:
+        key = RANKING_CACHE_KEY.format(version=version, scope='category', scope_id=category_id)
+    else:
+        key = RANKING_CACHE_KEY.format(version=version, scope='city', scope_id=city_id)
+    ranking = cache.get(key)
+    if ranking is None:
+        return None
+    return ranking[offset:offset + limit].tolist()
@@ -0,0 +1,235 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, connections, transaction
+from django.db.models import F
+from django.utils import timezone
+from django.utils.crypto import salted_hmac
+
+from billing.utils import rollback_customer
+from django_dialogflow.instrumentation import external_call
+from mailer.utils import send_mail_using_template_name
+from .models_c import (
+    STATUS_COMPLETED,
+    STATUS_CREATING_SUBSCRIPTION,
+    STATUS_FAILED,
+    STATUS_PENDING,
+    STATUS_SENDING_MAIL,
+    SignupJob,
+)
+from .utils import ChargebeeError, create_subscription, get_subscription
+
+logger = logging.getLogger(__name__)
+
+RESUMABLE_STATUSES = (STATUS_PENDING, STATUS_CREATING_SUBSCRIPTION, STATUS_SENDING_MAIL)
+
+MAX_ATTEMPTS = getattr(settings, 'SIGNUP_JOB_MAX_ATTEMPTS', 3)
+RETRY_BACKOFF = getattr(settings, 'SIGNUP_JOB_RETRY_BACKOFF', 2)
+# a running job touches its row on every step, one untouched for longer lost its worker
+STALE_AFTER = getattr(settings, 'SIGNUP_JOB_STALE_AFTER', 15 * 60)
+# runs of a job before the sweeper gives up on it and compensates
+MAX_RUNS = getattr(settings, 'SIGNUP_JOB_MAX_RUNS', 3)
+
+signup_executor = ThreadPoolExecutor(max_workers=getattr(settings, 'SIGNUP_JOB_WORKERS', 4))
+
+
+def get_signup_job_id(idempotency_key, email):
+    """
+    Job id of a signup sent with an Idempotency-Key header. The key is chosen by the client, so it is
+    scoped to the signup email and signed, nobody can look up another signup by guessing its key.
+    """
+    return salted_hmac('billing.signup_jobs', '{}:{}'.format((email or '').lower(), idempotency_key)).hexdigest()
+
+
+def get_signup_status(job_id):
+    job = SignupJob.objects.filter(job_id=job_id).first()
+    return job.get_status() if job else None
+
+
+def create_signup_job(job_id, account, plan_id, stripe_token):
+    """
+    Register a new signup job, call it within the transaction creating `account`.
+
+    Returns
+    -------
+    SignupJob
+        None when a job with this id already exists
+    """
+    try:
+        with transaction.atomic():
+            return SignupJob.objects.create(job_id=job_id, account=account, plan_id=plan_id or '',
+                                            stripe_token=stripe_token or '')
+    except IntegrityError:
+        return None
+
+
+def start_signup_job(job_id):
+    signup_executor.submit(run_in_worker, job_id)
+
+
+def run_in_worker(job_id):
+    try:
+        run_signup_job(job_id)
+    except Exception:
+        logger.exception('Signup job %s failed, left to resume_stale_signup_jobs', job_id)
+    finally:
+        connections.close_all()
+
+
+def set_signup_status(job, status, **fields):
+    job.status = status
+    for name, value in fields.items():
+        setattr(job, name, value)
+    job.save(update_fields=['status', 'updated_at'] + list(fields))
+
+
+def claim_signup_job(job_id, stale_before=None):
+    """
+    Take a job for running, atomically so that a job is never run twice at once: a new job is taken
+    by its first run only, an unfinished one once it was not touched since `stale_before`.
+
+    Returns
+    -------
+    SignupJob
+        None when the job is finished or taken by another worker
+    """
+    jobs = SignupJob.objects.filter(job_id=job_id)
+    if stale_before is None:
+        jobs = jobs.filter(status=STATUS_PENDING, runs=0)
+    else:
+        jobs = jobs.filter(status__in=RESUMABLE_STATUSES, updated_at__lt=stale_before)
+    if not jobs.update(runs=F('runs') + 1, updated_at=timezone.now()):
+        return None
+    return SignupJob.objects.select_related('account').get(job_id=job_id)
+
+
+def with_retries(func, *args, retry_if=lambda exception: True):
+    """
+    Call `func`, retrying up to MAX_ATTEMPTS times with exponential backoff while `retry_if(exception)`.
+    """
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        try:
+            return func(*args)
+        except Exception as e:
+            if attempt == MAX_ATTEMPTS or not retry_if(e):
+                raise
+            logger.warning('%s failed, attempt %d of %d', func.__name__, attempt, MAX_ATTEMPTS, exc_info=True)
+            time.sleep(RETRY_BACKOFF ** attempt)
+
+
+def has_subscription(account_id):
+    try:
+        with external_call('chargebee'):
+            return bool(get_subscription(account_id))
+    except ChargebeeError:
+        return False
+
+
+def subscribe_once(account, plan_id, stripe_token, resumed=False):
+    """
+    Callable creating the Chargebee subscription of `account` for `with_retries`. A retry, or a resumed
+    job, may follow an attempt which reached Chargebee but failed on the way back, so they check for it first.
+    """
+    attempts = [True] if resumed else []
+
+    def subscribe():
+        if attempts and has_subscription(account.id):
+            return
+        attempts.append(True)
+        with external_call('chargebee'):
+            create_subscription(account, plan_id, stripe_token)
+
+    subscribe.__name__ = 'create_subscription'
+    return subscribe
+
+
+def run_signup_job(job_id, stale_before=None):
+    """
+    Background part of a signup: create the Chargebee subscription, rolling the customer back when it
+    fails, then send the welcome mail. Transient errors are retried, Chargebee errors are final.
+
+    Every step is recorded on the SignupJob row, a job whose worker died is picked up again by
+    `resume_stale_signup_jobs` from its last step.
+    """
+    job = claim_signup_job(job_id, stale_before)
+    if job is None:
+        return
+    account = job.account
+
+    if job.status in (STATUS_PENDING, STATUS_CREATING_SUBSCRIPTION):
+        if account is None:
+            set_signup_status(job, STATUS_FAILED, reason='Not Found', message='Account was deleted', stripe_token='')
+            return
+        if job.runs > MAX_RUNS:
+            compensate_signup_job(job)
+            return
+
+        resumed = job.status == STATUS_CREATING_SUBSCRIPTION
+        set_signup_status(job, STATUS_CREATING_SUBSCRIPTION)
+        try:
+            with_retries(subscribe_once(account, job.plan_id, job.stripe_token, resumed),
+                         retry_if=lambda e: not isinstance(e, ChargebeeError))
+        except ChargebeeError as e:
+            rollback_customer(account)
+            set_signup_status(job, STATUS_FAILED, reason=str(e), message=str(e.exact), stripe_token='')
+            return
+        except Exception as e:
+            logger.exception('Subscription of account %s failed', account.pk)
+            rollback_customer(account)
+            set_signup_status(job, STATUS_FAILED, reason=str(e), message=str(e), stripe_token='')
+            return
+        set_signup_status(job, STATUS_SENDING_MAIL, stripe_token='')
+
+    if account is None or job.runs > MAX_RUNS:
+        set_signup_status(job, STATUS_COMPLETED, mail_sent=False)
+        return
+    try:
+        with_retries(send_mail_using_template_name, 'Welcome to BookedFusion!', dict(name=account.email),
+                     'mailer/billing_confirmation.html', account.email)
+        mail_sent = True
+    except Exception:
+        logger.exception('Welcome mail to account %s failed', account.pk)
+        mail_sent = False
+    set_signup_status(job, STATUS_COMPLETED, mail_sent=mail_sent)
+
+
+def compensate_signup_job(job):
+    """
+    Give up on a job whose subscription never completed: unless it was created after all, roll the
+    customer back and fail the job. Jobs with a subscription complete without the welcome mail.
+    """
+    if has_subscription(job.account_id):
+        set_signup_status(job, STATUS_COMPLETED, mail_sent=False, stripe_token='')
+        return
+    logger.error('Signup job %s of account %s abandoned after %d runs', job.job_id, job.account_id, job.runs - 1)
+    rollback_customer(job.account)
+    set_signup_status(job, STATUS_FAILED, reason='Signup abandoned',
+                      message='The subscription could not be created, please sign up again', stripe_token='')
+
+
+def resume_stale_signup_jobs(stale_after=None, batch_size=100):
+    """
+    Resume the signup jobs whose worker died, e.g. on a deploy or a crash, from their last step, and
+    compensate those which already ran SIGNUP_JOB_MAX_RUNS times. Run it periodically, e.g. from cron
+    every few minutes, jobs are run in the calling process.
+
+    Returns
+    -------
+    int
+        number of resumed jobs
+    """
+    stale_before = timezone.now() - timedelta(seconds=stale_after or STALE_AFTER)
+    job_ids = list(SignupJob.objects.filter(
+        status__in=RESUMABLE_STATUSES, updated_at__lt=stale_before
+    ).order_by('updated_at').values_list('job_id', flat=True)[:batch_size])
+
+    for job_id in job_ids:
+        logger.warning('Resuming stale signup job %s', job_id)
+        try:
+            run_signup_job(job_id, stale_before)
+        except Exception:
+            logger.exception('Resuming signup job %s failed', job_id)
+    return len(job_ids)
@@ -0,0 +1,200 @@
+import base64
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+from django.utils.crypto import constant_time_compare
+
+from django_dialogflow.instrumentation import external_call
+from openvbx.utils import get_booked_fusion_number
+from .utils import get_subscription
+
+logger = logging.getLogger(__name__)
+
+SUBSCRIPTION_CACHE_KEY = 'subscription:{account_id}'
+BOOKED_FUSION_NUMBER_CACHE_KEY = 'booked_fusion_number:{generalsettings_id}'
+REFRESH_LOCK_KEY = '{key}:refreshing'
+GENERATION_KEY = '{key}:generation'
+
+# served as is for `fresh_for` seconds, then served while refreshed in the background until `stale_for`
+SUBSCRIPTION_FRESH_FOR = getattr(settings, 'SUBSCRIPTION_CACHE_FRESH_FOR', 60)
+SUBSCRIPTION_STALE_FOR = getattr(settings, 'SUBSCRIPTION_CACHE_STALE_FOR', 60 * 60)
+# numbers are bought and released outside this app, keep them as fresh as subscriptions
+BOOKED_FUSION_NUMBER_FRESH_FOR = getattr(settings, 'BOOKED_FUSION_NUMBER_CACHE_FRESH_FOR', 60)
+BOOKED_FUSION_NUMBER_STALE_FOR = getattr(settings, 'BOOKED_FUSION_NUMBER_CACHE_STALE_FOR', 60 * 60)
+
+refresh_executor = ThreadPoolExecutor(max_workers=getattr(settings, 'SUBSCRIPTION_CACHE_WORKERS', 2))
+
+
+def get_stale_while_revalidate(key, loader, fresh_for, stale_for):
+    """
+    Get a cached value, loading it with `loader` on a miss. Values older than `fresh_for` seconds are
+    still returned but refreshed in the background, once across processes. A load started before the
+    key was invalidated, see `invalidate_cached_value`, is returned but not stored.
+
+    Parameters
+    ----------
+    key: str
+        cache key
+    loader: callable
+        loads the value, exceptions propagate on a miss
+    fresh_for: int
+        seconds a value is served without refreshing
+    stale_for: int
+        seconds a value is kept at all
+
+    Returns
+    -------
+    object
+        cached or loaded value
+    """
+    entry = cache.get(key)
+    if entry is None:
+        generation = get_generation(key)
+        return set_cached_value(key, loader(), stale_for, generation)
+
+    if time.time() - entry['fetched_at'] > fresh_for:
+        schedule_refresh(key, loader, stale_for)
+    return entry['value']
+
+
+def get_generation(key):
+    return cache.get(GENERATION_KEY.format(key=key))
+
+
+def set_cached_value(key, value, stale_for, generation=None):
+    """
+    Cache `value`; with a `generation` only if the key was not invalidated since it was read
+    """
+    if generation is None or generation == get_generation(key):
+        cache.set(key, {'value': value, 'fetched_at': time.time()}, stale_for)
+    return value
+
+
+def invalidate_cached_value(key):
+    """
+    Drop a cached value and make loads already in flight discard their result
+    """
+    cache.set(GENERATION_KEY.format(key=key), time.time_ns(), None)
+    cache.delete(key)
+
+
+def schedule_refresh(key, loader, stale_for):
+    if cache.add(REFRESH_LOCK_KEY.format(key=key), True, 30):
+        refresh_executor.submit(refresh_cached_value, key, loader, stale_for, get_generation(key))
+
+
+def refresh_cached_value(key, loader, stale_for, generation=None):
+    try:
+        set_cached_value(key, loader(), stale_for, generation)
+    except Exception:
+        # keep serving the stale value, the next read past `fresh_for` retries
+        logger.warning('Background refresh of %s failed', key, exc_info=True)
+    finally:
+        cache.delete(REFRESH_LOCK_KEY.format(key=key))
+        connections.close_all()
+
+
+def fetch_subscription(account_id):
+    with external_call('chargebee'):
+        return get_subscription(account_id)
+
+
+def get_cached_subscription(account_id):
+    """
+    Chargebee subscription of an account, see `get_stale_while_revalidate`
+
+    Raises
+    ------
+    ChargebeeError
+        when the subscription is not cached and Chargebee fails
+    """
+    account_id = int(account_id)
+    return get_stale_while_revalidate(
+        SUBSCRIPTION_CACHE_KEY.format(account_id=account_id), lambda: fetch_subscription(account_id),
+        SUBSCRIPTION_FRESH_FOR, SUBSCRIPTION_STALE_FOR
+    )
+
+
+def get_resource_version(subscription):
+    if isinstance(subscription, dict):
+        return subscription.get('resource_version')
+    return getattr(subscription, 'resource_version', None)
+
+
+def set_cached_subscription(account_id, subscription):
+    """
+    Cache a subscription pushed by Chargebee, unless the cached one has a newer `resource_version`,
+    webhook events may arrive out of order.
+
+    Returns
+    -------
+    bool
+        whether it was stored
+    """
+    key = SUBSCRIPTION_CACHE_KEY.format(account_id=int(account_id))
+    entry = cache.get(key)
+    cached_version = get_resource_version(entry['value']) if entry else None
+    version = get_resource_version(subscription)
+    if cached_version is not None and (version is None or version < cached_version):
+        return False
+
+    # refreshes in flight may have read an older subscription
+    invalidate_cached_value(key)
+    set_cached_value(key, subscription, SUBSCRIPTION_STALE_FOR)
+    return True
+
+
+def invalidate_subscription(account_id):
+    invalidate_cached_value(SUBSCRIPTION_CACHE_KEY.format(account_id=int(account_id)))
+
+
+def refresh_subscription(account_id):
+    """
+    Drop the cached subscription of an account after it changed and reload it in the background.
+    Refreshes started before the change discard what they read, see `invalidate_cached_value`.
+    """
+    account_id = int(account_id)
+    key = SUBSCRIPTION_CACHE_KEY.format(account_id=account_id)
+    invalidate_cached_value(key)
+    # a refresh still holding the lock is discarded, release it so the new state is loaded now
+    cache.delete(REFRESH_LOCK_KEY.format(key=key))
+    schedule_refresh(key, lambda: fetch_subscription(account_id), SUBSCRIPTION_STALE_FOR)
+
+
+def get_cached_booked_fusion_number(generalsettings_id):
+    return get_stale_while_revalidate(
+        BOOKED_FUSION_NUMBER_CACHE_KEY.format(generalsettings_id=generalsettings_id),
+        lambda: get_booked_fusion_number(generalsettings_id),
+        BOOKED_FUSION_NUMBER_FRESH_FOR, BOOKED_FUSION_NUMBER_STALE_FOR
+    )
+
+
+def invalidate_booked_fusion_number(generalsettings_id):
+    """
+    Drop the cached booked fusion number, call it wherever a number is bought or released.
+    """
+    invalidate_cached_value(BOOKED_FUSION_NUMBER_CACHE_KEY.format(generalsettings_id=generalsettings_id))
+
+
+def is_valid_webhook_request(request):
+    """
+    Check the HTTP basic auth credentials configured for Chargebee webhooks,
+    CHARGEBEE_WEBHOOK_USERNAME and CHARGEBEE_WEBHOOK_PASSWORD.
+    """
+    username = getattr(settings, 'CHARGEBEE_WEBHOOK_USERNAME', None)
+    password = getattr(settings, 'CHARGEBEE_WEBHOOK_PASSWORD', None)
+    if not username or not password:
+        return False
+
+    auth = request.META.get('HTTP_AUTHORIZATION', '').split(' ', 1)
+    if len(auth) != 2 or auth[0].lower() != 'basic':
+        return False
+    try:
+        credentials = base64.b64decode(auth[1]).decode('utf-8')
+    except (ValueError, UnicodeDecodeError):
+        return False
+    return constant_time_compare(credentials, '{}:{}'.format(username, password))
@@ -1,16 +1,19 @@
-import operator
-from collections import defaultdict
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, defaultdict
 
 from apps.utils import get_absolute_image_uri
 from apps.catalogue.models import Category
-from apps.cache_manager import CacheManager
 from django.core.cache import cache
 from django.utils import timezone as django_timezone
 from apps.utils import extract_day_and_time
+from django.db import connections, transaction
 from django.db.models import Q
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.conf import settings
 from apps.catalogue.models import Product
-from apps.search.deals_search_handler import DealSearchHandler
+from django_dialogflow.instrumentation import instrument, registry
 
 
 def get_category_dict(category, parent=True):
@@ -39,6 +42,28 @@ def get_category_dict(category, parent=True):
 
     return category_dict
 
+def get_category_node_dict(node, parent=True):
+    """
+    Helper to form category dict from a CategoryTreeIndex node, see `get_category_dict`
+    """
+    category_dict = {
+        'id': node['id'],
+        'name': node['name'],
+        'priority': node['priority'],
+    }
+    if parent:
+        category_dict['image'] = node['image']
+
+    return category_dict
+
+
+def get_category_sort_key(category):
+    """
+    Composite sort key, priority descending then name ascending
+    """
+    return -category['priority'], category['name']
+
+
 def get_sorted_categories(category_dict):
     """
         Helper to form sorted dict based on name and priority
@@ -55,20 +80,188 @@ def get_sorted_categories(category_dict):
 
     """
 
-    categories_values = list(category_dict)
-    categories_values.sort(key=operator.itemgetter('name'))
-    categories_values.sort(key=operator.itemgetter('priority'), reverse=True)
-    for index, value in enumerate(categories_values):
+    categories_values = sorted(category_dict, key=get_category_sort_key)
+    for value in categories_values:
         if value['child']:
-            categories_values[index]['child'].sort(key=operator.itemgetter('name'))
-            categories_values[index]['child'].sort(key=operator.itemgetter('priority'), reverse=True)
+            value['child'].sort(key=get_category_sort_key)
 
     return categories_values
 
 
+class CategoryTreeIndex(object):
+    """
+    In-memory index of the whole category tree, keyed by id and by materialised path.
+
+    Every node is a dict {'id': '', 'name': '', 'priority': '', 'image': '', 'path': '', 'depth': ''}.
+    """
+
+    def __init__(self, nodes, version=None):
+        self.version = version
+        self.nodes = list(nodes)
+        self.by_id = {node['id']: node for node in self.nodes}
+        self.by_path = {node['path']: node for node in self.nodes}
+
+    @classmethod
+    def from_db(cls, version=None):
+        categories = Category.objects.only('name', 'mobile_image', 'path', 'depth', 'priority')
+        return cls(
+            [dict(get_category_dict(category), path=category.path, depth=category.depth) for category in categories],
+            version
+        )
+
+    def get(self, category_id):
+        return self.by_id.get(int(category_id))
+
+    def get_ancestor(self, node, depth):
+        return self.by_path.get(node['path'][0:Category.steplen * depth])
+
+
+CATEGORY_TREE_CACHE_KEY = 'category_tree_index'
+CATEGORY_TREE_VERSION_CACHE_KEY = 'category_tree_index:version'
+
+_category_tree_index = None
+
+
+def get_category_tree_index():
+    """
+    Get the category tree index of this process, reloaded from cache (or the database when the
+    cache is cold) whenever the cached tree version changes.
+
+    Returns
+    -------
+    CategoryTreeIndex
+    """
+    global _category_tree_index
+
+    version = cache.get(CATEGORY_TREE_VERSION_CACHE_KEY)
+    if version is not None and _category_tree_index is not None and _category_tree_index.version == version:
+        return _category_tree_index
+
+    if version is None:
+        version = django_timezone.now().timestamp()
+        cache.add(CATEGORY_TREE_VERSION_CACHE_KEY, version, None)
+        version = cache.get(CATEGORY_TREE_VERSION_CACHE_KEY, version)
+
+    cached = cache.get(CATEGORY_TREE_CACHE_KEY)
+    if cached and cached[0] == version:
+        _category_tree_index = CategoryTreeIndex(cached[1], version)
+    else:
+        _category_tree_index = CategoryTreeIndex.from_db(version)
+        cache.set(CATEGORY_TREE_CACHE_KEY, (version, _category_tree_index.nodes), None)
+
+    return _category_tree_index
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def invalidate_category_tree_index(**kwargs):
+    """
+    Bump the category tree version so every process reloads its index on next use. The bump waits for
+    the saving transaction to commit, otherwise a concurrent reload could cache the old rows under the
+    new version.
+    """
+    transaction.on_commit(bump_category_tree_version)
+
+
+def bump_category_tree_version():
+    cache.set(CATEGORY_TREE_VERSION_CACHE_KEY, django_timezone.now().timestamp(), None)
+    cache.delete(CATEGORY_TREE_CACHE_KEY)
+
+
+class FrozenDict(dict):
+    """
+    dict which refuses mutation, so cached responses can be shared between callers. Use `copy()` to modify.
+    """
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError('{} is immutable'.format(type(self).__name__))
+
+    __setitem__ = __delitem__ = __ior__ = clear = pop = popitem = setdefault = update = _immutable
+
+    def __reduce__(self):
+        return type(self), (dict(self),)
+
+
+class LRUCache(object):
+    """
+    Thread safe, size bounded least recently used cache with hit/miss counters.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = 0
+
+    def info(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+        }
+
+
+category_hierarchy_cache = LRUCache(getattr(settings, 'CATEGORY_HIERARCHY_CACHE_SIZE', 1024))
+registry.register_gauges('category_hierarchy_cache', category_hierarchy_cache.info)
+
+
+def freeze_category_hierarchy(categories):
+    """
+    Helper to make a category hierarchy immutable
+
+    Parameters
+    ----------
+    categories: list of dict
+
+    Returns
+    -------
+    tuple of FrozenDict
+        children are frozen into tuples as well
+    """
+    return tuple(
+        FrozenDict(category, child=tuple(FrozenDict(child) for child in category['child']))
+        for category in categories
+    )
+
+
+def thaw_category_hierarchy(categories):
+    """
+    Mutable copy of a frozen category hierarchy, as lists of dicts
+    """
+    return [dict(category, child=[dict(child) for child in category['child']]) for category in categories]
+
+
+@instrument('get_category_hierarchy')
 def get_category_hierarchy(category_ids):
     """
     Prepare category hierarchy response for depth > 1. Flattens all the categories with depth >2 under common parent.
+    Callers get their own copy to modify, read only callers can share the memoised hierarchy through
+    `get_frozen_category_hierarchy` instead.
 
     Parameters
     ----------
@@ -80,44 +273,65 @@ def get_category_hierarchy(category_ids):
     object: list of dict
         in following format [ { id: '', image:'' , name:'' , child : [{id:'' , name:'' }]} ] or []
     """
+    return thaw_category_hierarchy(get_frozen_category_hierarchy(category_ids))
+
+
+def get_frozen_category_hierarchy(category_ids):
+    """
+    Category hierarchy of `get_category_hierarchy`, answered from the category tree index, see
+    `get_category_tree_index`, and memoised per id set and tree version in `category_hierarchy_cache`.
+
+    Returns
+    -------
+    object: tuple of FrozenDict
+        in following format ( { id: '', image:'' , name:'' , child : ({id:'' , name:'' },)}, ) or ()
+    """
     if not category_ids:
-        return []
+        return ()
+
+    index = get_category_tree_index()
+    key = (frozenset(int(category_id) for category_id in category_ids), index.version)
+    category_hierarchy = category_hierarchy_cache.get(key)
+    if category_hierarchy is None:
+        category_hierarchy = freeze_category_hierarchy(build_category_hierarchy(index, key[0]))
+        category_hierarchy_cache.set(key, category_hierarchy)
+
+    return category_hierarchy
+
 
+def build_category_hierarchy(index, category_ids):
+    """
+    Build the category hierarchy of `get_category_hierarchy` from the category tree index.
+
+    Parameters
+    ----------
+    index: CategoryTreeIndex
+    category_ids: set
+
+    Returns
+    -------
+    list of dict
+    """
     min_depth = 2
-    categories = Category.objects.filter(id__in=category_ids, depth__gte=min_depth).only(
-        'name', 'mobile_image', 'path', 'depth', 'priority'
-    ).distinct()
 
     parent_categories_map = defaultdict(lambda: {'child': []})
     child_categories_map = {}
-    l3_parent_category_paths = set()
 
-    for category in categories:
-        if category.depth == min_depth:
-            parent_categories_map[category.path].update(get_category_dict(category))
-        elif category.depth == min_depth + 1:
-            child_categories_map[category.path] = category
+    for category_id in category_ids:
+        category = index.get(category_id)
+        if category is None or category['depth'] < min_depth:
+            continue
+        if category['depth'] == min_depth:
+            parent_categories_map[category['path']].update(get_category_node_dict(category))
         else:
-            l3_parent_category_paths.add(category.path[0:Category.steplen * (min_depth + 1)])
-
-    l3_parent_category_paths = {path for path in l3_parent_category_paths if path not in child_categories_map.keys()}
-    child_categories_map.update(
-        {c.path: c for c in Category.objects.filter(path__in=l3_parent_category_paths).only('name', 'path')}
-    )
+            child_category = index.get_ancestor(category, min_depth + 1)
+            if child_category is not None:
+                child_categories_map[child_category['path']] = child_category
 
-    missing_category_paths = set()
     for category in child_categories_map.values():
-        parent_path = category.path[0:Category.steplen * min_depth]
-        if parent_path not in parent_categories_map.keys():
-            missing_category_paths.add(parent_path)
-        parent_categories_map[parent_path]['child'].append(get_category_dict(category, parent=False))
-
-    missing_parent_categories = Category.objects.filter(path__in=missing_category_paths).only(
-        'name', 'mobile_image', 'path', 'priority'
-    )
-
-    for category in missing_parent_categories:
-        parent_categories_map[category.path].update(get_category_dict(category))
+        parent_category = index.get_ancestor(category, min_depth)
+        parent_categories_map[parent_category['path']].update(get_category_node_dict(parent_category))
+        parent_categories_map[parent_category['path']]['child'].append(get_category_node_dict(category, parent=False))
 
     return get_sorted_categories(parent_categories_map.values())
 
@@ -151,9 +365,76 @@ def active_deal_type_partners(partner_category, filter_deal_type, user_location,
         set of partner ids which do have a deal available for user city, area and location.
 
     """
-    deal_type_partner_stocks = get_deal_type_product_stocks(partner_category, filter_deal_type, user_location, area, city_id)
-    deal_type_partners = set(stock[1] for stock in deal_type_partner_stocks)
-    return deal_type_partners
+    from apps.search.deals_search_handler import DealSearchHandler
+
+    deal_type_index = get_deal_type_index(partner_category, city_id)
+    excluded_products = DealSearchHandler.get_excluded_products(user_location, area)
+    return deal_type_index.get_partners(excluded_products, filter_deal_type)
+
+def active_deal_type_partners_batch(lookups, city_id, max_workers=None):
+    """
+    Find partners with applicable deals for many lookups of one city at once. Deal type indexes are
+    loaded once per partner category and excluded products once per distinct location and area,
+    concurrently on a thread pool.
+
+    Parameters
+    ----------
+    lookups: iterable
+        (partner_category, filter_deal_type, user_location, area) tuples, see `active_deal_type_partners`
+    city_id: int
+        city for which offers will be extracted
+    max_workers: int
+        thread pool size, defaults to the DEAL_TYPE_BATCH_WORKERS setting
+
+    Returns
+    -------
+    list
+        set of partner ids for every lookup, in lookup order
+    """
+    from apps.search.deals_search_handler import DealSearchHandler
+
+    lookups = list(lookups)
+    if not lookups:
+        return []
+
+    partner_categories = {lookup[0] for lookup in lookups}
+    locations = {get_location_key(lookup[2], lookup[3]): lookup[2:4] for lookup in lookups}
+
+    with ThreadPoolExecutor(max_workers=max_workers or getattr(settings, 'DEAL_TYPE_BATCH_WORKERS', 4)) as executor:
+        deal_type_index_futures = {
+            partner_category: executor.submit(run_in_thread, get_deal_type_index, partner_category, city_id)
+            for partner_category in partner_categories
+        }
+        excluded_products_futures = {
+            key: executor.submit(run_in_thread, DealSearchHandler.get_excluded_products, user_location, area)
+            for key, (user_location, area) in locations.items()
+        }
+
+    return [
+        deal_type_index_futures[partner_category].result().get_partners(
+            excluded_products_futures[get_location_key(user_location, area)].result(), filter_deal_type
+        )
+        for partner_category, filter_deal_type, user_location, area in lookups
+    ]
+
+
+def get_location_key(user_location, area):
+    """
+    Hashable key of a user location and delivery area
+    """
+    return (user_location.ewkt if user_location is not None else None,
+            area.pk if area is not None else None)
+
+
+def run_in_thread(func, *args):
+    """
+    Call `func` from a worker thread, closing the database connections the thread opened.
+    """
+    try:
+        return func(*args)
+    finally:
+        connections.close_all()
+
 
 def get_deal_type_product_stocks(partner_category, filter_deal_type, user_location, area, city_id):
     """
@@ -177,13 +458,121 @@ def get_deal_type_product_stocks(partner_category, filter_deal_type, user_locati
         list of tuples containing tuples of product and partner id
 
     """
-    deal_type_stocks = CacheManager.get_all_deal_type_stocks(partner_category, city_id)
+    from apps.search.deals_search_handler import DealSearchHandler
+
+    deal_type_index = get_deal_type_index(partner_category, city_id)
     excluded_products = DealSearchHandler.get_excluded_products(user_location, area)
+    return deal_type_index.get_stocks(excluded_products, filter_deal_type)
+
+
+# product ids per deal type lookup query
+DEAL_TYPE_LOOKUP_CHUNK_SIZE = 1000
 
-    deal_type_stocks = list(filter(lambda stock: stock[0] not in excluded_products, deal_type_stocks))
 
-    if filter_deal_type:
-        deal_type_products = Product.objects.filter(deal_type__slug__in=filter_deal_type).values_list('id', flat=True)
-        deal_type_stocks = list(filter(lambda stock: stock[0] in deal_type_products, deal_type_stocks))
+class DealTypeIndex(object):
+    """
+    Deal type stocks of one partner category and city with the product and partner ids they cover and
+    the product ids of every deal type slug as frozensets, so filtering is a set intersection.
+    """
 
-    return deal_type_stocks
\ No newline at end of file
+    def __init__(self, stocks, deal_type_products):
+        self.stocks = stocks
+        self.product_ids = frozenset(stock[0] for stock in stocks)
+        self.partner_ids = frozenset(stock[1] for stock in stocks)
+        self.deal_type_products = {slug: frozenset(ids) for slug, ids in deal_type_products.items()}
+
+    @classmethod
+    def build(cls, stocks, product_deal_types):
+        """
+        Parameters
+        ----------
+        stocks: list
+            (product id, partner id, ...) tuples as returned by CacheManager.get_all_deal_type_stocks
+        product_deal_types: iterable
+            (product id, deal type slug) tuples
+
+        Returns
+        -------
+        DealTypeIndex
+        """
+        deal_type_products = defaultdict(list)
+        for product_id, slug in product_deal_types:
+            deal_type_products[slug].append(product_id)
+        return cls(stocks, deal_type_products)
+
+    @classmethod
+    def from_stocks(cls, stocks):
+        """
+        Index of deal type stocks, with the deal types of the products they list.
+        """
+        product_ids = sorted(set(stock[0] for stock in stocks))
+        product_deal_types = []
+        for i in range(0, len(product_ids), DEAL_TYPE_LOOKUP_CHUNK_SIZE):
+            product_deal_types.extend(Product.objects.filter(
+                id__in=product_ids[i:i + DEAL_TYPE_LOOKUP_CHUNK_SIZE], deal_type__isnull=False
+            ).values_list('id', 'deal_type__slug'))
+        return cls.build(stocks, product_deal_types)
+
+    def get_products(self, excluded_products=(), filter_deal_type=None):
+        """
+        Set of product ids not excluded and, if `filter_deal_type` is given, of one of those deal types
+        """
+        products = self.product_ids
+        if filter_deal_type:
+            products = products & frozenset().union(*(
+                self.deal_type_products.get(slug, ()) for slug in filter_deal_type
+            ))
+        if excluded_products:
+            products = products.difference(excluded_products)
+        return products
+
+    def get_stocks(self, excluded_products=(), filter_deal_type=None):
+        products = self.get_products(excluded_products, filter_deal_type)
+        return [stock for stock in self.stocks if stock[0] in products]
+
+    def get_partners(self, excluded_products=(), filter_deal_type=None):
+        if not excluded_products and not filter_deal_type:
+            return set(self.partner_ids)
+        return set(stock[1] for stock in self.get_stocks(excluded_products, filter_deal_type))
+
+
+DEAL_TYPES_VERSION_CACHE_KEY = 'deal_type_index:deal_types_version'
+
+deal_type_index_cache = LRUCache(getattr(settings, 'DEAL_TYPE_INDEX_CACHE_SIZE', 256))
+registry.register_gauges('deal_type_index_cache', deal_type_index_cache.info)
+
+
+def get_deal_type_index(partner_category, city_id):
+    """
+    Get the deal type index of a partner category and city.
+
+    Stocks are read from CacheManager.get_all_deal_type_stocks on every call, as before, so refreshed
+    or expired deals show right away; the index built from them is memoised in this process per version
+    of product deal types, see `invalidate_deal_type_indexes`, and reused as long as the stocks equal
+    the ones it was built from.
+
+    Returns
+    -------
+    DealTypeIndex
+    """
+    from apps.cache_manager import CacheManager
+
+    stocks = CacheManager.get_all_deal_type_stocks(partner_category, city_id) or []
+    key = (partner_category, city_id, cache.get(DEAL_TYPES_VERSION_CACHE_KEY))
+    deal_type_index = deal_type_index_cache.get(key)
+    # compared item by item without copying, unlike hashing the stocks into a key
+    if deal_type_index is None or deal_type_index.stocks != stocks:
+        deal_type_index = DealTypeIndex.from_stocks(stocks)
+        deal_type_index_cache.set(key, deal_type_index)
+    return deal_type_index
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def invalidate_deal_type_indexes(**kwargs):
+    """
+    Product deal types changed, rebuild the deal type indexes of every process once the save commits.
+    """
+    transaction.on_commit(
+        lambda: cache.set(DEAL_TYPES_VERSION_CACHE_KEY, django_timezone.now().timestamp(), None)
+    )
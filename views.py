@@ -1,21 +1,44 @@
-from django.http import JsonResponse
+from django.contrib.admin.views.decorators import staff_member_required
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Max
+from django.http import JsonResponse, StreamingHttpResponse
 from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
-from django.contrib.sessions.models import Session
 from django.conf import settings
-from dialogflow_lite.dialogflow import Dialogflow
+from django.utils import timezone
+from asgiref.sync import sync_to_async
 
 import json
+import math
 
-from django.views.generic import ListView
+from django.views.generic import ListView, View
 from rest_framework import status
 from rest_framework.response import Response
 from rest_framework.views import APIView
-from rest_framework.viewsets import GenericViewSet
 
+from django_dialogflow.chat_history import compact_chat_response, expand_chat_response
+from django_dialogflow.chat_session import with_chat_session
+from django_dialogflow.dialogflow_client import (
+    DialogflowStatusError, DialogflowUnavailable, dialogflow_client, dialogflow_guard, dialogflow_pool,
+    dialogflow_response_cache
+)
+from django_dialogflow.instrumentation import instrument, registry
 from django_dialogflow.models import ChatHistory
 from django_dialogflow.serializers import ChatSerializer
+from django_dialogflow.write_behind import WriteBehindBuffer
+
+# chat history is written behind the response, in batches, see WriteBehindBuffer for the options.
+# Written raw, so time_stamp keeps the time of the message, see chat_dialogflow
+chat_history_buffer = WriteBehindBuffer(
+    ChatHistory, **dict({'raw': True}, **getattr(settings, 'CHAT_HISTORY_BUFFER', {}))
+)
+
+registry.register_gauges('chat_history_buffer', chat_history_buffer.info)
+registry.register_gauges('dialogflow_pool', dialogflow_pool.info)
+registry.register_gauges('dialogflow_response_cache', dialogflow_response_cache.info)
+registry.register_gauges('dialogflow_admission', dialogflow_guard.limiter.info)
+registry.register_gauges('dialogflow_circuit_breaker', dialogflow_guard.breaker.info)
 
 
 def convert(data):
@@ -31,13 +54,11 @@ def convert(data):
 
 @require_http_methods(['POST'])
 @method_decorator(csrf_exempt)
+@instrument('chat_view')
+@with_chat_session
 def chat_view(request):
-    dialogflow = Dialogflow(**settings.DIALOGFLOW)
     input_dict = convert(request.body)
     input_text = json.loads(input_dict)['text']
-    if not request.session.session_key:
-        request.session.save()
-    dialogflow.session_id = request.session.session_key
 
     if request.method == "GET":
         # Return a method not allowed response
@@ -47,7 +68,12 @@ def chat_view(request):
         }
         return JsonResponse(data, status=405)
     elif request.method == "POST":
-        data = chat_dialogflow(dialogflow, input_text)
+        try:
+            data = pooled_chat_dialogflow(request.chat_session_id, input_text)
+        except DialogflowUnavailable as e:
+            return unavailable_response(JsonResponse(get_unavailable_data(e, '/chat'), status=503), e)
+        except DialogflowStatusError:
+            return JsonResponse(get_upstream_error_data('/chat'), status=502)
         return JsonResponse(data, status=200)
     elif request.method == "PATCH":
         data = {
@@ -69,30 +95,61 @@ def chat_view(request):
 
 
 class ChatHistoryListView(ListView):
+    """
+    Chat history grouped by session, paginated by session with the most recently active first.
+    """
     model = ChatHistory
     template_name = "chat_history.html"
+    paginate_by = 50
+
+    def get_queryset(self):
+        return ChatHistory.objects.values('session_id').annotate(latest=Max('time_stamp')).order_by('-latest')
 
     def get_context_data(self, *args, **kwargs):
         context = super(ChatHistoryListView, self).get_context_data(*args, **kwargs)
-        result_dict = dict()
-        for object in ChatHistory.objects.all().order_by('-time_stamp'):
-            if object.session_id in result_dict:
-                result_dict[object.session_id].append(object)
-            else:
-                result_dict[object.session_id] = [object]
+        result_dict = {session['session_id']: [] for session in context['object_list']}
+        for object in ChatHistory.objects.filter(session_id__in=result_dict.keys()).order_by('-time_stamp'):
+            # the template reads fields which are packed in compact responses
+            object.chat_response = expand_chat_response(object.chat_response)
+            result_dict[object.session_id].append(object)
 
         context['chat_history'] = result_dict
         return context
 
 
+@method_decorator(staff_member_required, name='dispatch')
+class ChatHistoryExportView(View):
+    """
+    Streams the whole chat history as JSON lines, read in primary key chunks so neither the database
+    driver nor the worker holds more than `chunk_size` rows at a time.
+    """
+    chunk_size = 2000
+
+    def get(self, request):
+        response = StreamingHttpResponse(self.iter_lines(), content_type='application/x-ndjson')
+        response['Content-Disposition'] = 'attachment; filename="chat_history.jsonl"'
+        return response
+
+    def iter_lines(self):
+        last_pk = 0
+        while True:
+            chunk = list(ChatHistory.objects.filter(pk__gt=last_pk).order_by('pk').values(
+                'pk', 'session_id', 'time_stamp', 'chat_request', 'chat_response'
+            )[:self.chunk_size])
+            if not chunk:
+                return
+            for row in chunk:
+                row['chat_response'] = expand_chat_response(row['chat_response'])
+                yield json.dumps(row, cls=DjangoJSONEncoder) + '\n'
+            last_pk = chunk[-1]['pk']
+
+
+@with_chat_session
 def chat_session_view(request):
-    if not request.session.session_key:
-        request.session.save()
-
     if request.method == "GET":
         # Return a method not allowed response
         data = {
-            'session_id': request.session.session_key,
+            'session_id': request.chat_session_id,
         }
         return JsonResponse(data, status=200)
     else:
@@ -114,25 +171,66 @@ class ChatAPI(APIView):
         }
         return Response(data, status=status.HTTP_400_BAD_REQUEST)
 
+    @instrument('ChatAPI.post')
     def post(self, request, format=None):
         serializer = ChatSerializer(data=request.data)
         if serializer.is_valid():
 
-            dialogflow = Dialogflow(**settings.DIALOGFLOW)
             input_text = serializer.data.get('text')
-            dialogflow.session_id = serializer.data.get('php_session')
-
-            return Response(chat_dialogflow(dialogflow, input_text), status=status.HTTP_201_CREATED)
+            session_id = serializer.data.get('php_session')
+
+            try:
+                data = pooled_chat_dialogflow(session_id, input_text)
+            except DialogflowUnavailable as e:
+                return unavailable_response(
+                    Response(get_unavailable_data(e, '/chat_api'), status=status.HTTP_503_SERVICE_UNAVAILABLE), e
+                )
+            except DialogflowStatusError:
+                return Response(get_upstream_error_data('/chat_api'), status=status.HTTP_502_BAD_GATEWAY)
+            return Response(data, status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
+def get_unavailable_data(error, name):
+    return {
+        'detail': 'The chat is busy, please try again shortly.',
+        'reason': error.reason,
+        'name': name,
+    }
+
+
+def get_upstream_error_data(name):
+    return {
+        'detail': 'The chat could not answer, please try again.',
+        'reason': 'upstream error',
+        'name': name,
+    }
+
+
+def unavailable_response(response, error):
+    response['Retry-After'] = str(math.ceil(error.retry_after))
+    return response
+
+
 def chat_dialogflow(dialogflow, input_text):
-    responses = dialogflow.text_request(str(input_text))
+    responses = dialogflow_response_cache.text_request(dialogflow, str(input_text))
     dialogflowData = dialogflow.query_response.get('result')
 
     dialogflowMessages = dialogflowData['fulfillment']['messages']
-    ChatHistory.objects.create(chat_request=input_text,
-                               chat_response=dialogflow.query_response.get("result"),
-                               session_id=dialogflow.session_id
-                               )
-    return dict(text=dialogflowMessages, session_id=dialogflow.session_id)
\ No newline at end of file
+    # stamped now, a batch written later would otherwise get the time it was flushed, the buffer writes
+    # it as is even if time_stamp is auto_now_add
+    chat_history_buffer.put(ChatHistory(chat_request=input_text,
+                                        chat_response=compact_chat_response(dialogflowData),
+                                        session_id=dialogflow.session_id,
+                                        time_stamp=timezone.now()
+                                        ))
+    return dict(text=dialogflowMessages, session_id=dialogflow.session_id)
+
+
+def pooled_chat_dialogflow(session_id, input_text):
+    with dialogflow_client(session_id) as dialogflow:
+        return chat_dialogflow(dialogflow, input_text)
+
+
+# awaitable chat_dialogflow for async views, runs the blocking Dialogflow call on a worker thread
+achat_dialogflow = sync_to_async(pooled_chat_dialogflow, thread_sensitive=False)
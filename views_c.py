@@ -1,23 +1,36 @@
+import uuid
+
+from django.db import transaction
 from rest_framework.permissions import AllowAny
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from rest_framework import status
 from authentication_user.models import Account
-from billing.utils import rollback_customer
-from openvbx.utils import get_booked_fusion_number
+from django_dialogflow.instrumentation import external_call, instrument
 from .serializers import RegisterUserSerializer, SubscriptionSerializer, AccountSerializer
+from .signup_jobs import (
+    STATUS_PENDING,
+    create_signup_job,
+    get_signup_job_id,
+    get_signup_status,
+    start_signup_job
+)
+from .subscription_cache import (
+    get_cached_booked_fusion_number,
+    get_cached_subscription,
+    is_valid_webhook_request,
+    refresh_subscription,
+    set_cached_subscription,
+    invalidate_subscription
+)
 from .utils import (
     ChargebeeError,
-    create_subscription,
-    get_subscription,
     cancel_subscription,
     check_status,
     reactivate_subscription
 )
 from authentication_user.serializers import AccountModelSerializer
 
-from mailer.utils import send_mail_using_template_name
-
 
 class RegisterView(APIView):
     permission_classes = (AllowAny,)
@@ -31,40 +44,71 @@ class RegisterView(APIView):
 
 
 class SubscriptionView(APIView):
+    """
+    Signup. The account is committed within the request, the Chargebee subscription and the welcome
+    mail follow in a background job whose progress is polled through SignupStatusView with the returned
+    job id. Requests are deduplicated by their Idempotency-Key header, scoped to the signup email.
+    """
     permission_classes = (AllowAny,)
     serializer_class = SubscriptionSerializer
 
+    @instrument('SubscriptionView.post')
     def post(self, request, format=None):
-        account = Account()
-        account.init_generalsettings_id()
-        data = request.data.copy()
-        data['generalsettings'] = account.generalsettings_id
-        data['is_active'] = True
-        data['name'] = request.data.get('first_name')
-        serializer = AccountModelSerializer(instance=account, data=data)
-        serializer.is_valid(raise_exception=True)
-        serializer.save()
-        serializer.instance.set_password(serializer.validated_data['password'])
-        serializer.instance.is_provider = True
-        serializer.instance.is_admin = True
-        serializer.instance.save()
-        serializer.instance.create_default_working_pan()
-
-        try:
-            create_subscription(account, request.data.get('plan_id'), request.data.get('stripe_token'))
-        except ChargebeeError as e:
-            rollback_customer(account)
-            return Response({'status': 'error', 'reason': str(e), 'message': str(e.exact)},
-                            status=status.HTTP_400_BAD_REQUEST)
+        idempotency_key = request.META.get('HTTP_IDEMPOTENCY_KEY')
+        if idempotency_key:
+            job_id = get_signup_job_id(idempotency_key, request.data.get('email'))
+            signup_status = get_signup_status(job_id)
+            if signup_status:
+                return Response(signup_status, status=status.HTTP_202_ACCEPTED)
+        else:
+            job_id = uuid.uuid4().hex
+
+        with transaction.atomic():
+            account = Account()
+            account.init_generalsettings_id()
+            data = request.data.copy()
+            data['generalsettings'] = account.generalsettings_id
+            data['is_active'] = True
+            data['name'] = request.data.get('first_name')
+            serializer = AccountModelSerializer(instance=account, data=data)
+            serializer.is_valid(raise_exception=True)
+            serializer.save()
+            serializer.instance.set_password(serializer.validated_data['password'])
+            serializer.instance.is_provider = True
+            serializer.instance.is_admin = True
+            serializer.instance.save()
+            serializer.instance.create_default_working_pan()
+
+            if not create_signup_job(job_id, serializer.instance, request.data.get('plan_id'),
+                                     request.data.get('stripe_token')):
+                transaction.set_rollback(True)
+                return Response(get_signup_status(job_id), status=status.HTTP_202_ACCEPTED)
+
+            transaction.on_commit(lambda: start_signup_job(job_id))
+
+        return Response({'status': STATUS_PENDING, 'job_id': job_id}, status=status.HTTP_202_ACCEPTED)
+
+
+class SignupStatusView(APIView):
+    """
+    Progress of a signup. Job ids are random or signed, see get_signup_job_id, so only the client
+    which made the signup knows its id.
+    """
+    permission_classes = (AllowAny,)
 
-        send_mail_using_template_name('Welcome to BookedFusion!', dict(name=account.email),
-                                      'mailer/billing_confirmation.html', account.email, )
-        return Response({'status': 'ok'}, status=status.HTTP_201_CREATED)
+    @instrument('SignupStatusView.get')
+    def get(self, request, job_id, format=None):
+        signup_status = get_signup_status(job_id)
+        if signup_status is None:
+            return Response({'status': 'error', 'reason': 'Not Found', 'message': 'Unknown signup'},
+                            status=status.HTTP_404_NOT_FOUND)
+        return Response(signup_status, status=status.HTTP_200_OK)
 
 
 class CancelSubscriptionView(APIView):
     serializer_class = AccountSerializer
 
+    @instrument('CancelSubscriptionView.post')
     def post(self, request, format=None):
         serializer = AccountSerializer(data=request.data)
         serializer.is_valid(raise_exception=True)
@@ -75,7 +119,9 @@ class CancelSubscriptionView(APIView):
                             status=status.HTTP_401_UNAUTHORIZED)
 
         try:
-            end_at = cancel_subscription(serializer.validated_data['account_id'])
+            with external_call('chargebee'):
+                end_at = cancel_subscription(serializer.validated_data['account_id'])
+            refresh_subscription(serializer.validated_data['account_id'])
             return Response({'status': 'ok', 'end_at': end_at}, status=status.HTTP_200_OK)
         except ChargebeeError as e:
             return Response({'status': 'error', 'reason': str(e), 'message': str(e.exact)},
@@ -83,6 +129,7 @@ class CancelSubscriptionView(APIView):
 
 
 class FetchSubscriptionView(APIView):
+    @instrument('FetchSubscriptionView.get')
     def get(self, request, account_id, format=None):
         if request.user.id != int(account_id):
             return Response({'status': 'error',
@@ -90,7 +137,7 @@ class FetchSubscriptionView(APIView):
                              'message': 'You do not have permission to perform this operation'},
                             status=status.HTTP_401_UNAUTHORIZED)
         try:
-            subscription = get_subscription(account_id)
+            subscription = get_cached_subscription(account_id)
         except ChargebeeError as e:
             return Response({'status': 'error', 'reason': str(e), 'message': str(e.exact)},
                             status=status.HTTP_400_BAD_REQUEST)
@@ -98,9 +145,10 @@ class FetchSubscriptionView(APIView):
 
 
 class StatusSubscription(APIView):
+    @instrument('StatusSubscription.get')
     def get(self, request):
         try:
-            subscription = get_subscription(request.user.id)
+            subscription = get_cached_subscription(request.user.id)
         except ChargebeeError as e:
             return Response({'status': 'error', 'reason': str(e), 'message': str(e.exact)},
                             status=status.HTTP_400_BAD_REQUEST)
@@ -113,13 +161,14 @@ class StatusSubscription(APIView):
             'next_billing': subscription.get('next_billing_at', False),
         }
         subscription_data.update(check_status(subscription['status']))
-        subscription_data.update(get_booked_fusion_number(request.user.generalsettings.pk))
+        subscription_data.update(get_cached_booked_fusion_number(request.user.generalsettings_id))
         return Response(subscription_data, status=status.HTTP_200_OK)
 
 
 class ReactivateSubscription(APIView):
     serializer_class = AccountSerializer
 
+    @instrument('ReactivateSubscription.post')
     def post(self, request, format=None):
         serializer = AccountSerializer(data=request.data)
         serializer.is_valid(raise_exception=True)
@@ -130,8 +179,36 @@ class ReactivateSubscription(APIView):
                             status=status.HTTP_401_UNAUTHORIZED)
 
         try:
-            reactivate_at = reactivate_subscription(serializer.validated_data['account_id'])
+            with external_call('chargebee'):
+                reactivate_at = reactivate_subscription(serializer.validated_data['account_id'])
+            refresh_subscription(serializer.validated_data['account_id'])
             return Response({'status': 'ok', 'reactivated_at': reactivate_at}, status=status.HTTP_200_OK)
         except ChargebeeError as e:
             return Response({'status': 'error', 'reason': str(e), 'message': str(e.exact)},
                             status=status.HTTP_400_BAD_REQUEST)
+
+
+class SubscriptionWebhookView(APIView):
+    """
+    Chargebee webhook, pushes subscription changes into the subscription cache.
+    Chargebee customers are keyed by account id.
+    """
+    permission_classes = (AllowAny,)
+    authentication_classes = ()
+
+    @instrument('SubscriptionWebhookView.post')
+    def post(self, request, format=None):
+        if not is_valid_webhook_request(request):
+            return Response({'status': 'error', 'reason': 'Not Authorized'}, status=status.HTTP_401_UNAUTHORIZED)
+
+        content = request.data.get('content') or {}
+        subscription = content.get('subscription')
+        customer = content.get('customer') or {}
+        try:
+            if subscription:
+                set_cached_subscription(subscription['customer_id'], subscription)
+            elif customer.get('id'):
+                invalidate_subscription(customer['id'])
+        except (KeyError, TypeError, ValueError):
+            pass
+        return Response({'status': 'ok'}, status=status.HTTP_200_OK)
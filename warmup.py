@@ -0,0 +1,60 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+from django_dialogflow.instrumentation import boot_timeline
+
+logger = logging.getLogger(__name__)
+
+
+def warm_up(city_ids=None, partner_categories=None, max_workers=None):
+    """
+    Preload what the first requests of a fresh worker would otherwise load on demand: the category
+    tree index and the deal type index of every partner category and city, plus the heavy modules
+    imported lazily. Call it before the worker accepts traffic, e.g. at the end of wsgi.py or from a
+    gunicorn `post_worker_init` hook. Failures are logged and never stop the worker from booting.
+
+    Each step is recorded in `boot_timeline`, exported with the other metrics.
+
+    Parameters
+    ----------
+    city_ids: iterable
+        defaults to the WARMUP_CITY_IDS setting
+    partner_categories: iterable
+        defaults to the WARMUP_PARTNER_CATEGORIES setting
+    max_workers: int
+        thread pool size for the deal type indexes, defaults to the WARMUP_WORKERS setting
+    """
+    from django_dialogflow.utils import get_category_tree_index, get_deal_type_index, run_in_thread
+
+    city_ids = getattr(settings, 'WARMUP_CITY_IDS', ()) if city_ids is None else city_ids
+    if partner_categories is None:
+        partner_categories = getattr(settings, 'WARMUP_PARTNER_CATEGORIES', ())
+
+    boot_timeline.mark('warm_up_started')
+
+    with boot_timeline.phase('warm_up_imports'):
+        for module in getattr(settings, 'WARMUP_IMPORTS', (
+            'apps.cache_manager', 'apps.search.deals_search_handler', 'dialogflow_lite.dialogflow',
+        )):
+            run_step(__import__, module)
+
+    with boot_timeline.phase('warm_up_category_tree'):
+        run_step(get_category_tree_index)
+
+    with boot_timeline.phase('warm_up_deal_type_indexes'):
+        lookups = [(partner_category, city_id) for city_id in city_ids for partner_category in partner_categories]
+        if lookups:
+            with ThreadPoolExecutor(max_workers=max_workers or getattr(settings, 'WARMUP_WORKERS', 4)) as executor:
+                for lookup in lookups:
+                    executor.submit(run_step, run_in_thread, get_deal_type_index, *lookup)
+
+    boot_timeline.mark('ready')
+
+
+def run_step(func, *args):
+    try:
+        func(*args)
+    except Exception:
+        logger.exception('warm up step %s%r failed', getattr(func, '__name__', func), args)
@@ -0,0 +1,165 @@
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+
+from django.db import close_old_connections
+
+logger = logging.getLogger(__name__)
+
+OVERFLOW_DROP = 'drop'
+OVERFLOW_BLOCK = 'block'
+OVERFLOW_SYNC = 'sync'
+
+
+class WriteBehindBuffer(object):
+    """
+    Queues unsaved model instances and writes them with `bulk_create` from a background thread,
+    whenever `batch_size` instances are queued or `flush_interval` seconds passed since the first one.
+
+    The queue holds at most `max_size` instances, beyond that `overflow` decides:
+        'drop'  discard the instance and count it in `dropped`
+        'block' wait up to `block_timeout` seconds for room, then drop
+        'sync'  save the instance in the calling thread
+
+    Queued instances are flushed on interpreter exit.
+
+    With `raw` instances are inserted with their field values as they are, without the `pre_save` of
+    their fields, so e.g. a time stamped on an `auto_now_add` field when queued is not replaced by the
+    time of the write.
+
+    Usage
+    -----
+    chat_history_buffer = WriteBehindBuffer(ChatHistory, batch_size=200)
+    chat_history_buffer.put(ChatHistory(session_id=session_id, ...))
+    """
+
+    def __init__(self, model, batch_size=100, flush_interval=1.0, max_size=10000, overflow=OVERFLOW_DROP,
+                 block_timeout=0.05, raw=False):
+        self.model = model
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_size = max_size
+        self.overflow = overflow
+        self.block_timeout = block_timeout
+        self.raw = raw
+
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+
+        self._queue = queue.Queue(max_size)
+        self._lock = threading.Lock()
+        self._pid = None
+        self._thread = None
+        self._stopping = threading.Event()
+        atexit.register(self.close)
+
+    def put(self, instance):
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(instance)
+            return
+        except queue.Full:
+            pass
+
+        if self.overflow == OVERFLOW_SYNC:
+            self._write([instance])
+            return
+        if self.overflow == OVERFLOW_BLOCK:
+            try:
+                self._queue.put(instance, timeout=self.block_timeout)
+                return
+            except queue.Full:
+                pass
+
+        with self._lock:
+            self.dropped += 1
+
+    def flush(self):
+        """
+        Write everything queued so far from the calling thread.
+        """
+        batch = []
+        while True:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+            if len(batch) >= self.batch_size:
+                self._write(batch)
+                batch = []
+        if batch:
+            self._write(batch)
+
+    def close(self, timeout=5.0):
+        self._stopping.set()
+        if self._thread is not None and self._pid == os.getpid():
+            self._thread.join(timeout)
+        self.flush()
+
+    def info(self):
+        return {
+            'depth': self._queue.qsize(),
+            'max_size': self.max_size,
+            'written': self.written,
+            'dropped': self.dropped,
+            'failed': self.failed,
+        }
+
+    def _ensure_started(self):
+        # started lazily and once per process, threads do not survive a fork of a preloaded app
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._stopping.clear()
+                self._thread = threading.Thread(
+                    target=self._run, name='write-behind-{}'.format(self.model.__name__), daemon=True
+                )
+                self._thread.start()
+                self._pid = os.getpid()
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                batch = [self._queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                continue
+
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            # only in the writer thread, from a request thread this would close the request's connection
+            close_old_connections()
+            self._write(batch)
+
+    def _write(self, batch):
+        try:
+            if self.raw:
+                self._insert_raw(batch)
+            else:
+                self.model.objects.bulk_create(batch, batch_size=self.batch_size)
+        except Exception:
+            logger.exception('Failed to write %d %s', len(batch), self.model.__name__)
+            with self._lock:
+                self.failed += len(batch)
+        else:
+            with self._lock:
+                self.written += len(batch)
+
+    def _insert_raw(self, batch):
+        opts = self.model._meta
+        fields = [field for field in opts.local_concrete_fields
+                  if not (field.primary_key and getattr(field, 'db_returning', False))]
+        for i in range(0, len(batch), self.batch_size):
+            # the raw insert bulk_create does for fixtures, field values are not pre_saved
+            self.model._base_manager._insert(batch[i:i + self.batch_size], fields=fields, raw=True)